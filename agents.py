@@ -1,12 +1,16 @@
 # agents.py
 
+import asyncio
+import contextvars
 import os
 from dotenv import load_dotenv
-from openai import OpenAI
 import logging
 
-# Import the web search tool
-from tools import web_search
+# Import the web search tools
+from tools import web_search, web_search_results, SearchCache, SEARCH_TIMEOUT, search_executor
+# Shared async OpenAI plumbing
+from llm import achat, run_sync, AnalysisInterrupted
+from result_cache import normalize_company_name
 
 # Set up logging
 logger = logging.getLogger('btmodel-web')
@@ -14,8 +18,8 @@ logger = logging.getLogger('btmodel-web')
 # Load environment variables from .env
 load_dotenv()
 
-# Instantiate the OpenAI client using the API key from .env
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+# Bump when agent or facilitator prompts change so cached analyses are not reused
+PROMPT_VERSION = "2"
 
 # Helper function to remove quotation marks from facilitator messages
 def clean_quotation_marks(text):
@@ -55,18 +59,26 @@ class BaseBTAgent:
             "Your answer should sound like something a human expert would say in a casual professional conversation."
         )
 
-    def get_response(self, input_text):
+    def get_response(self, input_text, on_delta=None):
+        return run_sync(self.aget_response(input_text, on_delta=on_delta))
+
+    async def aget_response(self, input_text, on_delta=None):
+        """Get the agent's answer; on_delta receives streamed tokens if given"""
         try:
             logger.info(f"Getting response from {self.agent_name}")
-            response = client.chat.completions.create(
+            return await achat(
                 model="gpt-4o",  # Using gpt-4o for better responses
                 messages=[
                     {"role": "system", "content": self.instructions},
                     {"role": "user", "content": input_text}
                 ],
-                temperature=0.7
+                temperature=0.7,
+                on_delta=on_delta,
+                agent=self.agent_name,
+                phase="turn"
             )
-            return response.choices[0].message.content.strip()
+        except AnalysisInterrupted:
+            raise
         except Exception as e:
             logger.error(f"Error getting response from {self.agent_name}: {str(e)}")
             return f"[Error generating response from {self.agent_name}: {str(e)}]"
@@ -116,19 +128,119 @@ class InnovationAnalyst(BaseBTAgent):
         )
         super().__init__(agent_name, personality, instructions)
 
+# Expert agents available to the discussion, in their default speaking order
+EXPERT_AGENTS = {
+    "Business Strategist": BusinessStrategist,
+    "Product Manager": ProductManager,
+    "Technology Officer": TechnologyOfficer,
+    "Innovation Analyst": InnovationAnalyst
+}
+
+def create_agents(names=None):
+    """Instantiate the named expert agents (all of them by default), keeping their order"""
+    names = names or list(EXPERT_AGENTS)
+    return {name: EXPERT_AGENTS[name]() for name in names}
+
 # ---------------------------
 # Research Agent
 # ---------------------------
+# Research shared by batch analyses, keyed by normalized company name
+research_cache = SearchCache(
+    max_entries=int(os.environ.get("RESEARCH_CACHE_SIZE", "1000")),
+    ttl_seconds=float(os.environ.get("RESEARCH_CACHE_TTL", str(24 * 3600)))
+)
+
 class ResearchAgent:
-    def __init__(self):
-        pass
+    # Targeted searches used by the "multi" research mode
+    RESEARCH_QUERIES = {
+        "Products and services": "{company} products and services",
+        "Financials": "{company} revenue financial results",
+        "Technology stack": "{company} technology stack engineering",
+        "Recent news": "{company} latest news",
+        "Competitors": "{company} competitors market share"
+    }
+
+    def __init__(self, mode=None, context_budget=None):
+        # "single" does one search for the company name, "multi" fans out RESEARCH_QUERIES
+        self.mode = mode or os.environ.get("RESEARCH_MODE", "single")
+        # Maximum characters of search snippets passed to the summarization call
+        self.context_budget = context_budget or int(os.environ.get("RESEARCH_CONTEXT_CHARS", "12000"))
 
     def run(self, company_name):
+        return run_sync(self.arun(company_name))
+
+    def run_shared(self, company_name):
+        return run_sync(self.arun_shared(company_name))
+
+    async def arun_shared(self, company_name):
+        """Like arun(), but reuses research other callers did or are doing for the same company"""
+        async def compute():
+            research_data = await self.arun(company_name)
+            # Fallback text from a failed search is not worth sharing
+            return research_data, "could not be retrieved" not in research_data
+        return await research_cache.aget_or_compute(normalize_company_name(company_name), compute)
+
+    async def search(self, search_fn, query):
+        """
+        Run a blocking search on a search thread, giving up after twice
+        SEARCH_TIMEOUT in case the search library does not time out itself.
+        """
+        loop = asyncio.get_running_loop()
+        search = loop.run_in_executor(search_executor, contextvars.copy_context().run, search_fn, query)
+        try:
+            return await asyncio.wait_for(search, SEARCH_TIMEOUT * 2)
+        except asyncio.TimeoutError:
+            logger.warning(f"Web search timed out for: {query}")
+            return None
+
+    async def gather_search_results(self, company_name):
+        """
+        Run all targeted queries concurrently, so latency is bounded by the
+        slowest one, and merge the deduplicated snippets within the budget.
+        Returns None if no query found anything.
+        """
+        topics = list(self.RESEARCH_QUERIES)
+        queries = [self.RESEARCH_QUERIES[topic].format(company=company_name) for topic in topics]
+        logger.info(f"Running {len(queries)} research queries in parallel for {company_name}")
+        
+        results = await asyncio.gather(*(self.search(web_search_results, query) for query in queries))
+        
+        # Take snippets round-robin across topics so one topic cannot use up the budget
+        seen = set()
+        selected = {topic: [] for topic in topics}
+        used = 0
+        pending = {topic: list(topic_results or []) for topic, topic_results in zip(topics, results)}
+        while any(pending.values()) and used < self.context_budget:
+            for topic in topics:
+                if not pending[topic]:
+                    continue
+                result = pending[topic].pop(0)
+                fingerprint = " ".join(result["snippet"].lower().split())
+                if fingerprint in seen:
+                    continue
+                line = f"{result['title']}: {result['snippet']}"
+                if used + len(line) > self.context_budget:
+                    pending[topic] = []
+                    continue
+                seen.add(fingerprint)
+                selected[topic].append(line)
+                used += len(line)
+        
+        sections = [f"{topic}:\n" + "\n\n".join(lines) for topic, lines in selected.items() if lines]
+        if not sections:
+            logger.warning(f"Research queries for {company_name} returned no results")
+            return None
+        return "\n\n".join(sections)
+
+    async def arun(self, company_name):
         try:
             logger.info(f"Researching {company_name}")
             
-            # Use web search tool to get information
-            web_results = web_search(company_name)
+            # Use web search tool to get information (blocking, so keep it off the event loop)
+            if self.mode == "multi":
+                web_results = await self.gather_search_results(company_name)
+            else:
+                web_results = await self.search(web_search, company_name)
             
             if not web_results or "Error retrieving search results" in web_results:
                 logger.warning(f"Web search for {company_name} returned no/error results")
@@ -142,19 +254,21 @@ class ResearchAgent:
                 "Focus on their business model, products/services, market position, technology stack if available, and recent developments."
             )
             
-            response = client.chat.completions.create(
+            research_data = await achat(
                 model="gpt-4o",
                 messages=[
                     {"role": "system", "content": "You are a research assistant. Create a clear, comprehensive business summary."},
                     {"role": "user", "content": prompt}
                 ],
-                temperature=0.7
+                temperature=0.7,
+                agent="Research Agent",
+                phase="research"
             )
-            
-            research_data = response.choices[0].message.content.strip()
             logger.info(f"Research completed for {company_name}")
             return research_data
             
+        except AnalysisInterrupted:
+            raise
         except Exception as e:
             logger.error(f"Error in ResearchAgent: {str(e)}")
             # Fallback to a generic response in case of error
@@ -170,33 +284,56 @@ class SummarizationAgent:
             "and expert discussion into key insights and recommendations. Format as a business brief with appropriate headings and structure."
         )
 
-    def summarize(self, research_data, conversation_transcript):
+    def summarize(self, research_data, conversation_transcript, on_delta=None, brief=False):
+        return run_sync(self.asummarize(research_data, conversation_transcript, on_delta=on_delta, brief=brief))
+
+    async def asummarize(self, research_data, conversation_transcript, on_delta=None, brief=False):
+        """
+        Create the executive summary; on_delta receives streamed tokens if given.
+        brief asks for a short summary, used when the analysis ran out of time.
+        """
         try:
-            logger.info("Generating summary")
+            logger.info("Generating brief summary" if brief else "Generating summary")
             
-            input_text = (
-                f"Research Data:\n{research_data}\n\n"
-                f"Expert Discussion Transcript:\n{conversation_transcript}\n\n"
-                "Please provide a comprehensive executive summary with the following sections:\n"
-                "1. Overview\n"
-                "2. Key Business Insights\n"
-                "3. Technology Considerations\n"
-                "4. Recommendations\n"
-                "5. Conclusion"
-            )
+            if brief:
+                input_text = (
+                    f"Research Data:\n{research_data}\n\n"
+                    f"Expert Discussion Transcript (cut short by a time limit):\n{conversation_transcript}\n\n"
+                    "Please provide a short executive summary of at most 250 words with the following sections:\n"
+                    "1. Overview\n"
+                    "2. Key Insights\n"
+                    "3. Recommendations"
+                )
+            else:
+                input_text = (
+                    f"Research Data:\n{research_data}\n\n"
+                    f"Expert Discussion Transcript:\n{conversation_transcript}\n\n"
+                    "Please provide a comprehensive executive summary with the following sections:\n"
+                    "1. Overview\n"
+                    "2. Key Business Insights\n"
+                    "3. Technology Considerations\n"
+                    "4. Recommendations\n"
+                    "5. Conclusion"
+                )
             
-            response = client.chat.completions.create(
+            summary = await achat(
                 model="gpt-4o",
                 messages=[
                     {"role": "system", "content": self.instructions},
                     {"role": "user", "content": input_text}
                 ],
-                temperature=0.7
+                temperature=0.7,
+                max_tokens=400 if brief else None,
+                on_delta=on_delta,
+                agent="Summarizer",
+                phase="summary"
             )
             
             logger.info("Summary generation completed")
-            return response.choices[0].message.content.strip()
+            return summary
             
+        except AnalysisInterrupted:
+            raise
         except Exception as e:
             logger.error(f"Error in SummarizationAgent: {str(e)}")
             return f"Summary generation failed: {str(e)}. Please review the research data and expert discussion directly."
\ No newline at end of file
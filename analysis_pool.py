@@ -0,0 +1,131 @@
+# analysis_pool.py
+
+import asyncio
+import contextvars
+import logging
+import threading
+from collections import deque
+
+from llm import get_event_loop
+
+# Set up logging
+logger = logging.getLogger('btmodel-web')
+
+class QueueFullError(Exception):
+    """Raised when the analysis queue cannot accept more work"""
+    pass
+
+# ---------------------------
+# Analysis Worker Pool
+# ---------------------------
+class AnalysisPool:
+    """
+    Runs analyses as coroutines on the shared event loop, at most
+    max_workers at a time, so a waiting analysis holds no thread.
+    Jobs wait in a bounded FIFO queue; submissions beyond the queue depth are
+    rejected so a burst of requests cannot start unbounded LLM pipelines.
+    """
+
+    def __init__(self, max_workers=4, max_queue=20, on_queue_change=None):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        # Called with [(session_id, position), ...] whenever waiting jobs move up
+        self.on_queue_change = on_queue_change
+
+        self._queue = deque()
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def submit(self, session_id, fn, *args):
+        """
+        Queue the coroutine fn(*args) for the given session. Returns the
+        1-based queue position, None if the job started right away, or
+        raises QueueFullError.
+        """
+        with self._lock:
+            if len(self._queue) >= self.max_queue:
+                raise QueueFullError(f"Analysis queue is full ({self.max_queue} waiting)")
+
+            self._queue.append((session_id, fn, args))
+
+        self._start_waiting()
+        position = self.position(session_id)
+        if position:
+            logger.info(f"Queued analysis for session {session_id} at position {position}")
+        return position
+
+    def position(self, session_id):
+        """Return the 1-based queue position of a waiting session, or None"""
+        with self._lock:
+            for index, (queued_id, _, _) in enumerate(self._queue):
+                if queued_id == session_id:
+                    return index + 1
+        return None
+
+    def cancel(self, session_id):
+        """
+        Drop a session's job if it is still waiting.
+        Returns True if it was removed, False if it already started or never existed.
+        """
+        with self._lock:
+            for index, (queued_id, _, _) in enumerate(self._queue):
+                if queued_id == session_id:
+                    del self._queue[index]
+                    break
+            else:
+                return False
+            waiting = [(queued_id, index + 1) for index, (queued_id, _, _) in enumerate(self._queue)]
+
+        logger.info(f"Removed cancelled analysis for session {session_id} from the queue")
+        self._report_positions(waiting)
+        return True
+
+    def session_ids(self):
+        """Sessions that are running or waiting in this pool"""
+        with self._lock:
+            return list(self._running) + [queued_id for queued_id, _, _ in self._queue]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": len(self._running),
+                "queued": len(self._queue)
+            }
+
+    def _report_positions(self, waiting):
+        if waiting and self.on_queue_change:
+            try:
+                self.on_queue_change(waiting)
+            except Exception as e:
+                logger.error(f"Error reporting queue positions: {str(e)}")
+
+    def _start_waiting(self):
+        """Start queued jobs on the event loop while fewer than max_workers run"""
+        started = []
+        with self._lock:
+            while self._queue and len(self._running) < self.max_workers:
+                session_id, fn, args = self._queue.popleft()
+                self._running.add(session_id)
+                started.append((session_id, fn, args))
+            waiting = [(queued_id, index + 1) for index, (queued_id, _, _) in enumerate(self._queue)]
+
+        loop = get_event_loop()
+        for session_id, fn, args in started:
+            # Each job gets a fresh context, so context variables it sets
+            # (such as the current session) do not leak into the next job
+            contextvars.Context().run(asyncio.run_coroutine_threadsafe, self._run(session_id, fn, args), loop)
+        if started:
+            self._report_positions(waiting)
+
+    async def _run(self, session_id, fn, args):
+        try:
+            await fn(*args)
+        except Exception as e:
+            logger.error(f"Unhandled error in analysis for session {session_id}: {str(e)}")
+        finally:
+            with self._lock:
+                self._running.discard(session_id)
+            # Starting the next job reports queue positions, which may block
+            await asyncio.to_thread(self._start_waiting)
@@ -1,15 +1,31 @@
-from flask import Flask, render_template, request, jsonify
-from flask_socketio import SocketIO, emit
+from flask import Flask, render_template, request, jsonify, Response, send_file
+from flask_socketio import SocketIO, emit, join_room
+import asyncio
 import os
 import uuid
 import logging
-import time
 import threading
+import time
+import weakref
 from dotenv import load_dotenv
-from openai import OpenAI
 
 # Import agent-related modules
-from agents import BusinessStrategist, ProductManager, TechnologyOfficer, InnovationAnalyst, SummarizationAgent, ResearchAgent, clean_quotation_marks
+from agents import SummarizationAgent, ResearchAgent, EXPERT_AGENTS, create_agents, research_cache, PROMPT_VERSION
+from analysis_pool import AnalysisPool, QueueFullError
+from batch import BatchRunner, read_companies
+from checkpoint import CheckpointStore
+from event_log import InMemoryEventLog, RedisEventLog
+from discussion import DiscussionEngine, LLMFacilitator, DEFAULT_ROUNDS, MAX_ROUNDS, DEFAULT_ROUND_BUDGET
+from llm import (
+    pool_stats, analysis_deadline, analysis_cancel, CancellationToken, BlockingCalls, run_sync,
+    AnalysisCancelled, DeadlineExceeded, DEFAULT_MODEL
+)
+from metrics import registry, recent_calls, current_session, PHASE_LATENCY, Timeline
+from presence import SessionPresence
+from result_cache import ResultCache
+from scheduler import scheduler
+from tools import search_cache
+from session_store import InMemorySessionStore, RedisSessionStore, EXPIRED
 
 # Set up logging
 logging.basicConfig(
@@ -21,21 +37,226 @@ logger = logging.getLogger('btmodel-web')
 # Load environment variables
 load_dotenv()
 
+def is_enabled(value):
+    """Whether a form field or environment flag is switched on"""
+    return str(value).lower() in ("1", "true", "on", "yes")
+
 # Initialize Flask app
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get("SECRET_KEY", "dev-secret-key")
 
 # Enhanced SocketIO configuration
+# With SOCKETIO_MESSAGE_QUEUE (e.g. a Redis URL) events emitted by a worker in
+# one process reach clients connected to any other process. Compression is
+# left at the engineio defaults: polling responses over 1 KB are gzipped and
+# the websocket transport (simple-websocket) negotiates permessage-deflate
+# with browsers that offer it. `python benchmark.py wire-check` keeps the
+# payloads themselves small.
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE") or None
 socketio = SocketIO(
     app, 
     cors_allowed_origins="*",
     ping_timeout=60,
     ping_interval=25,
-    async_mode='threading'
+    async_mode='threading',
+    message_queue=SOCKETIO_MESSAGE_QUEUE
 )
 
-# Dictionary to store ongoing analysis sessions
-active_sessions = {}
+# Store for ongoing and recently completed analysis sessions. Use the Redis
+# backend when more than one app process serves the same deployment.
+SESSION_TTL = float(os.environ.get("SESSION_TTL", str(6 * 3600)))
+if os.environ.get("SESSION_BACKEND", "memory") == "redis":
+    active_sessions = RedisSessionStore.from_url(
+        os.environ.get("REDIS_URL", "redis://localhost:6379/0"),
+        ttl_seconds=SESSION_TTL
+    )
+else:
+    active_sessions = InMemorySessionStore(
+        ttl_seconds=SESSION_TTL,
+        max_entries=int(os.environ.get("SESSION_MAX_ENTRIES", "1000")),
+        max_bytes=int(os.environ.get("SESSION_MAX_BYTES", str(200 * 1024 * 1024))),
+        sweep_interval=float(os.environ.get("SESSION_SWEEP_INTERVAL", "60")),
+        # Analyses that have not finished are never evicted for space
+        pinned=lambda session: session.get("status") not in FINISHED_STATUSES
+    )
+
+# Sequence-numbered log of the events sent to each session, replayed to
+# clients that reconnect so they only receive what they missed
+EVENT_LOG_MAX_EVENTS = int(os.environ.get("EVENT_LOG_MAX_EVENTS", "500"))
+if isinstance(active_sessions, RedisSessionStore):
+    event_log = RedisEventLog(active_sessions.client, ttl_seconds=SESSION_TTL, max_events=EVENT_LOG_MAX_EVENTS)
+else:
+    event_log = InMemoryEventLog(
+        max_sessions=int(os.environ.get("SESSION_MAX_ENTRIES", "1000")),
+        max_events=EVENT_LOG_MAX_EVENTS,
+        max_bytes=int(os.environ.get("EVENT_LOG_MAX_BYTES", str(20 * 1024 * 1024)))
+    )
+    # A session's events go when the store evicts or expires the session
+    active_sessions.on_remove = event_log.delete
+
+# Token-by-token events are superseded by the full message, so they are not logged
+TRANSIENT_EVENTS = ("message_delta",)
+
+# Seq order only has to hold within a session, so each session has its own
+# emit lock. Locks live while some thread holds or waits for them; an idle
+# session's lock is dropped and a fresh one is just as good.
+emit_locks = weakref.WeakValueDictionary()
+emit_locks_guard = threading.Lock()
+
+def session_emit_lock(session_id):
+    with emit_locks_guard:
+        lock = emit_locks.get(session_id)
+        if lock is None:
+            lock = emit_locks[session_id] = threading.Lock()
+        return lock
+
+def report_queue_positions(waiting):
+    """Tell queued sessions their position when they are queued and whenever a job leaves the queue"""
+    for session_id, position in waiting:
+        # Stored too, so processes other than this one can report it
+        active_sessions.update(session_id, queue_position=position)
+        emit_to_session(session_id, 'status_update', {
+            'session_id': session_id,
+            'status': 'queued',
+            'queue_position': position,
+            'message': f"Waiting for an available analyst (position {position} in queue)..."
+        })
+
+# Pauses between messages used to be slept on the server; clients now pace
+# playback from the event timestamps, so this is off unless SERVER_PACING is set
+SERVER_PACING = is_enabled(os.environ.get("SERVER_PACING", ""))
+
+# Completed analyses are cached on disk so repeat companies are served instantly
+RESULT_CACHE_PATH = os.environ.get("RESULT_CACHE_PATH", "result_cache.sqlite3")
+result_cache = ResultCache(
+    RESULT_CACHE_PATH,
+    version=f"{PROMPT_VERSION}/{DEFAULT_MODEL}",
+    ttl_seconds=float(os.environ.get("RESULT_CACHE_TTL", str(7 * 24 * 3600))),
+    max_entries=int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", "500"))
+) if RESULT_CACHE_PATH else None
+
+# Every completed phase and turn of a running analysis is checkpointed, so
+# one interrupted by a restart resumes from its last step. A checkpoint not
+# refreshed for three CHECKPOINT_INTERVALs is taken over by any process.
+CHECKPOINT_PATH = os.environ.get("CHECKPOINT_PATH", "checkpoints.sqlite3")
+CHECKPOINT_INTERVAL = float(os.environ.get("CHECKPOINT_INTERVAL", "15"))
+checkpoints = CheckpointStore(CHECKPOINT_PATH) if CHECKPOINT_PATH else None
+
+# Time limit for a whole analysis; when it is reached the discussion stops,
+# a short summary is written within SUMMARY_GRACE_SECONDS and the session
+# is marked "partial". A deadline during research skips straight to the
+# summary, and a short summary that overruns the grace period is replaced
+# by what exists so far.
+ANALYSIS_DEADLINE = float(os.environ.get("ANALYSIS_DEADLINE_SECONDS", "900"))
+SUMMARY_GRACE_SECONDS = float(os.environ.get("SUMMARY_GRACE_SECONDS", "60"))
+
+def fallback_summary(research_data, transcript):
+    """Summary of a partial analysis for which not even the short summary could be written in time"""
+    parts = ["The analysis ran out of time before an executive summary could be written."]
+    if transcript.turns:
+        parts.append("Expert discussion so far:\n" + transcript.text())
+    elif research_data:
+        parts.append("Research:\n\n" + research_data)
+    return "\n\n".join(parts)
+
+# Bounded worker pool that runs the analyses
+analysis_pool = AnalysisPool(
+    max_workers=int(os.environ.get("MAX_CONCURRENT_ANALYSES", "4")),
+    max_queue=int(os.environ.get("MAX_QUEUED_ANALYSES", "20")),
+    on_queue_change=report_queue_positions
+)
+
+# Batches of companies run on a separate bounded pool (see batch.py)
+batch_runner = BatchRunner(lambda *args: aanalyze_company(*args))
+
+# Statuses after which an analysis no longer runs
+FINISHED_STATUSES = ("complete", "partial", "error", "cancelled")
+
+# Cancellation tokens of the analyses running in this process
+cancel_tokens = {}
+
+# An analysis is cancelled once every client that watched it (over Socket.IO
+# or by polling /check_session) has been gone for this many seconds, long
+# enough to cover page navigation and reconnects (0 = never). Presence is
+# only known to the process the clients are connected to, so with several
+# processes sharing a message queue nothing is cancelled automatically.
+CANCEL_GRACE_SECONDS = float(os.environ.get("CANCEL_GRACE_SECONDS", "60"))
+if SOCKETIO_MESSAGE_QUEUE and CANCEL_GRACE_SECONDS:
+    logger.info("SOCKETIO_MESSAGE_QUEUE is set, abandoned analyses will not be cancelled automatically")
+    CANCEL_GRACE_SECONDS = 0
+presence = SessionPresence(
+    CANCEL_GRACE_SECONDS,
+    on_abandoned=lambda session_id: cancel_analysis(session_id, "no clients watching")
+)
+
+# Compact wire format: research_complete and analysis_complete reference the
+# research and summary texts instead of carrying them, message events only
+# carry the conversation_state fields that changed, and streamed tokens are
+# batched. Off sends full payloads.
+COMPACT_EVENTS = is_enabled(os.environ.get("COMPACT_EVENTS", "1"))
+
+# Compact format: streamed tokens are sent in batches at most this often
+STREAM_FLUSH_SECONDS = float(os.environ.get("STREAM_FLUSH_SECONDS", "0.1"))
+
+# Large session texts that compact events reference, served by /session/<id>/<name>
+SESSION_TEXTS = ("research_data", "summary")
+
+def text_ref(session_id, name, text):
+    """Reference to a session text in place of the text itself"""
+    return {"url": f"/session/{session_id}/{name}", "length": len(text)}
+
+def analysis_options(form):
+    """
+    Read the per-request discussion settings, falling back to the server
+    defaults. Raises ValueError for settings that cannot be honoured.
+    """
+    try:
+        rounds = int(form.get('rounds') or DEFAULT_ROUNDS)
+        round_budget = float(form.get('round_budget') or DEFAULT_ROUND_BUDGET)
+    except (TypeError, ValueError):
+        raise ValueError("Rounds and round budget must be numbers")
+    if not 1 <= rounds <= MAX_ROUNDS:
+        raise ValueError(f"Rounds must be between 1 and {MAX_ROUNDS}")
+    
+    # A comma-separated string from forms and the environment, or a list from JSON
+    experts = form.get('experts') or os.environ.get("DISCUSSION_EXPERTS", "")
+    if isinstance(experts, str):
+        experts = experts.split(',')
+    if not isinstance(experts, list) or not all(isinstance(name, str) for name in experts):
+        raise ValueError("Experts must be a list of names or a comma-separated string")
+    experts = [name.strip() for name in experts if name.strip()]
+    unknown = [name for name in experts if name not in EXPERT_AGENTS]
+    if unknown:
+        raise ValueError(f"Unknown experts: {', '.join(unknown)}")
+    
+    return {
+        # Opt-in mode where round one opinions are fetched concurrently
+        "parallel_roundtable": is_enabled(form.get('parallel_roundtable', os.environ.get("PARALLEL_ROUNDTABLE", ""))),
+        # Opt-in mode where tokens are forwarded to the browser as they are generated
+        "stream_responses": is_enabled(form.get('stream_responses', os.environ.get("STREAM_RESPONSES", ""))),
+        "rounds": rounds,
+        "experts": list(dict.fromkeys(experts)) or list(EXPERT_AGENTS),
+        # Seconds a round may take before its remaining speakers are skipped (0 = no limit)
+        "round_budget": max(round_budget, 0),
+        # Let the facilitator end the discussion early once the experts agree
+        "stop_on_consensus": is_enabled(form.get('stop_on_consensus', os.environ.get("STOP_ON_CONSENSUS", "")))
+    }
+
+def cache_variant(options):
+    """Cache key suffix for discussions that differ from the default shape, or None"""
+    variant = []
+    if options["rounds"] != DEFAULT_ROUNDS:
+        variant.append(f"rounds={options['rounds']}")
+    if options["experts"] != list(EXPERT_AGENTS):
+        variant.append("experts=" + ",".join(options["experts"]))
+    if options["round_budget"]:
+        variant.append(f"budget={options['round_budget']:g}")
+    if options["stop_on_consensus"]:
+        variant.append("consensus")
+    if options["parallel_roundtable"]:
+        # Round one opinions are given without hearing the other experts
+        variant.append("parallel")
+    return ";".join(variant) or None
 
 # ----------------------------------------------------------------------
 # Routes
@@ -52,41 +273,153 @@ def start_analysis():
         if not company_name:
             return jsonify({"error": "Company name is required"}), 400
         
+        try:
+            options = analysis_options(request.form)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # Skip the cache when the user explicitly asks for a fresh analysis
+        force_refresh = is_enabled(request.form.get('force_refresh', ''))
+        
         logger.info(f"Starting analysis for company: {company_name}")
         
         # Generate a unique session ID
         session_id = str(uuid.uuid4())
         
+        # Serve a previously completed analysis of the same company straight away
+        variant = cache_variant(options)
+        cached_result = result_cache.get(company_name, variant) if result_cache and not force_refresh else None
+        if cached_result:
+            logger.info(f"Serving cached analysis for {company_name}")
+            active_sessions.create(session_id, {
+                "company_name": company_name,
+                "status": "complete",
+                "research_data": cached_result["research_data"],
+                "transcript": cached_result["transcript"],
+                "summary": cached_result["summary"],
+                "cached_at": cached_result["cached_at"],
+                "started_at": time.time()
+            })
+            return jsonify({"session_id": session_id, "cached": True})
+        
         # Initialize session data
-        active_sessions[session_id] = {
+        active_sessions.create(session_id, {
             "company_name": company_name,
-            "status": "initialized",
+            "status": "queued",
             "research_data": "",
             "transcript": [],
             "summary": "",
+            "options": options,
             "started_at": time.time()
-        }
+        })
         
-        # Start the analysis in a background thread
-        analysis_thread = threading.Thread(target=run_analysis, args=(session_id, company_name))
-        analysis_thread.daemon = True
-        analysis_thread.start()
+        if checkpoints:
+            checkpoints.start(session_id, company_name, options, time.time())
         
-        return jsonify({"session_id": session_id})
+        # Hand the analysis to the worker pool, rejecting it if the queue is full
+        try:
+            position = analysis_pool.submit(
+                session_id, arun_analysis, session_id, company_name, options
+            )
+        except QueueFullError as e:
+            logger.warning(f"Rejecting analysis for {company_name}: {str(e)}")
+            active_sessions.delete(session_id)
+            event_log.delete(session_id)
+            if checkpoints:
+                checkpoints.finish(session_id)
+            return jsonify({"error": "The server is busy with other analyses. Please try again in a few minutes."}), 429
+        if position:
+            # Also logged, so the page gets it when it joins the session
+            report_queue_positions([(session_id, position)])
+        
+        return jsonify({"session_id": session_id, "queue_position": position})
     
     except Exception as e:
         logger.error(f"Error starting analysis: {str(e)}")
         return jsonify({"error": "Failed to start analysis. Please try again."}), 500
 
+@app.route('/batch_analysis', methods=['POST'])
+def start_batch():
+    """
+    Start analyses for a list of companies: a CSV or JSON file uploaded as
+    "companies" with the analysis settings as form fields, or a JSON body
+    {"companies": [...], "options": {...}}. Progress is at
+    /batch_analysis/<batch_id> and results at /batch_analysis/<batch_id>/results.
+    """
+    try:
+        upload = request.files.get('companies')
+        if upload:
+            names = read_companies(upload.read().decode('utf-8-sig'), upload.filename or "")
+            form = request.form
+        else:
+            names = read_companies(request.get_data(as_text=True), "body.json" if request.is_json else "")
+            data = request.get_json(silent=True)
+            form = (data.get("options") or {}) if isinstance(data, dict) else {}
+        
+        job = batch_runner.submit(names, analysis_options(form), refresh=is_enabled(form.get('force_refresh', '')))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except QueueFullError as e:
+        logger.warning(f"Rejecting batch: {str(e)}")
+        return jsonify({"error": "Too many batch analyses are waiting. Please try again later."}), 429
+    except Exception as e:
+        logger.error(f"Error starting batch: {str(e)}")
+        return jsonify({"error": "Failed to start batch. Please try again."}), 500
+    
+    return jsonify(job.progress()), 202
+
+@app.route('/batch_analysis/<batch_id>')
+def batch_progress(batch_id):
+    job = batch_runner.get(batch_id)
+    if job is None:
+        return jsonify({"error": "Batch not found"}), 404
+    return jsonify(job.progress())
+
+@app.route('/batch_analysis/<batch_id>/results')
+def batch_results(batch_id):
+    """The batch's JSONL output so far, one line per finished company"""
+    job = batch_runner.get(batch_id)
+    if job is None:
+        return jsonify({"error": "Batch not found"}), 404
+    return send_file(os.path.abspath(job.output_path), mimetype='application/x-ndjson')
+
+@app.route('/cancel_analysis/<session_id>', methods=['POST'])
+def cancel_analysis_endpoint(session_id):
+    """Cancel a queued or running analysis"""
+    if session_id not in active_sessions:
+        return jsonify({"error": "Session not found", "status": "error"}), 404
+    if not cancel_analysis(session_id, "requested over HTTP"):
+        return jsonify({"error": "Analysis is not running"}), 409
+    return jsonify({"session_id": session_id, "status": "cancelling"})
+
 @app.route('/results/<session_id>')
 def results(session_id):
     # Check if session exists
+    state = active_sessions.state(session_id)
+    if state == EXPIRED:
+        logger.info(f"Requested expired session: {session_id}")
+        return render_template('index.html', error="This analysis has expired. Please start a new analysis.")
     if session_id not in active_sessions:
         logger.warning(f"Requested nonexistent session: {session_id}")
         return render_template('index.html', error="Analysis session not found or expired.")
     
     return render_template('results.html', session_id=session_id)
 
+@app.route('/session/<session_id>/<name>')
+def session_text(session_id, name):
+    """Serve one large text of a session, for events that only reference it"""
+    if name not in SESSION_TEXTS:
+        return jsonify({"error": "Unknown session text"}), 404
+    session = active_sessions.get(session_id)
+    if session is None:
+        if active_sessions.state(session_id) == EXPIRED:
+            return jsonify({"error": "Session expired", "status": "expired"}), 410
+        return jsonify({"error": "Session not found", "status": "error"}), 404
+    
+    response = Response(session.get(name) or "", mimetype="text/plain")
+    response.add_etag()
+    return response.make_conditional(request)
+
 @app.route('/check_session/<session_id>')
 def check_session(session_id):
     """
@@ -94,18 +427,33 @@ def check_session(session_id):
     This provides a fallback for clients when WebSocket updates fail.
     """
     try:
-        if session_id in active_sessions:
+        session = active_sessions.get(session_id)
+        if session is not None:
             # Return a simplified version of the session data
             session_data = {
-                "status": active_sessions[session_id]["status"],
-                "company_name": active_sessions[session_id]["company_name"]
+                "status": session["status"],
+                "company_name": session["company_name"]
             }
             
-            # If analysis is complete, include the summary
-            if active_sessions[session_id]["status"] == "complete":
-                session_data["summary"] = active_sessions[session_id]["summary"]
+            # A polling client is watching the analysis as much as a socket is
+            if session_data["status"] not in FINISHED_STATUSES:
+                presence.poll(session_id)
+            
+            # If the analysis is still waiting for a worker, include its place in line
+            if session_data["status"] == "queued":
+                session_data["queue_position"] = analysis_pool.position(session_id) or session.get("queue_position")
+            
+            # Where the analysis has spent its time so far
+            session_data["started_at"] = session.get("started_at")
+            session_data["timeline"] = session.get("timeline", [])
+            
+            # If analysis is complete (or was cut short by the deadline), include the summary
+            if session["status"] in ("complete", "partial"):
+                session_data["summary"] = session["summary"]
             
             return jsonify(session_data)
+        elif active_sessions.state(session_id) == EXPIRED:
+            return jsonify({"error": "Session expired", "status": "expired"}), 410
         else:
             logger.warning(f"Requested status for nonexistent session: {session_id}")
             return jsonify({"error": "Session not found", "status": "error"}), 404
@@ -135,20 +483,84 @@ def debug_sessions():
     
     return jsonify({
         "active_sessions_count": len(active_sessions),
+        "session_store": active_sessions.stats(),
+        "analysis_pool": analysis_pool.stats(),
         "sessions": safe_sessions
     })
 
+@app.route('/debug/openai_pool')
+def debug_openai_pool():
+    """DEBUG ONLY: Connection pool counters and rate limit budget for the shared OpenAI client"""
+    if not app.debug:
+        return jsonify({"error": "Debug endpoints only available in debug mode"}), 403
+    
+    return jsonify(dict(pool_stats(), scheduler=scheduler.stats()))
+
+@app.route('/metrics')
+def metrics():
+    """LLM call and analysis phase metrics in the Prometheus text format"""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/debug/llm_calls')
+def debug_llm_calls():
+    """DEBUG ONLY: Recent LLM calls with latency and tokens, optionally for one session"""
+    if not app.debug:
+        return jsonify({"error": "Debug endpoints only available in debug mode"}), 403
+    
+    session_id = request.args.get('session_id')
+    calls = [call for call in list(recent_calls) if not session_id or call["session_id"] == session_id]
+    return jsonify({"calls": calls})
+
+@app.route('/debug/search_cache')
+def debug_search_cache():
+    """DEBUG ONLY: Hit, miss and coalesced counters for the web search cache"""
+    if not app.debug:
+        return jsonify({"error": "Debug endpoints only available in debug mode"}), 403
+    
+    return jsonify(dict(search_cache.stats(), research=research_cache.stats()))
+
 # ----------------------------------------------------------------------
 # WebSocket Events
 # ----------------------------------------------------------------------
 
 @socketio.on('get_session_data')
 def get_session_data(data):
+    """
+    Subscribe the client to a session. A client that passes last_seq (the
+    seq of the last event it handled, 0 for none) gets the events it missed
+    as one session_events batch; otherwise, or if those events are no longer
+    logged, it gets the whole session as session_data, with the seq it is
+    current to.
+    """
     try:
         session_id = data.get('session_id')
-        if session_id in active_sessions:
+        last_seq = data.get('last_seq')
+        # Read under the session's emit lock so no event falls between the snapshot and its seq
+        with session_emit_lock(session_id):
+            seq = event_log.last_seq(session_id)
+            session_data = active_sessions.get(session_id)
+        if session_data is not None:
+            # Subscribe this client to the session's room so it only receives
+            # events for the analysis it is watching
+            join_room(session_id)
+            if session_data["status"] not in FINISHED_STATUSES:
+                presence.join(request.sid, session_id)
+            
+            if last_seq is not None:
+                events = event_log.since(session_id, int(last_seq))
+                if events is not None:
+                    logger.info(f"Sending {len(events)} missed events for {session_id}")
+                    emit('session_events', {'session_id': session_id, 'events': events})
+                    return
+            
             logger.info(f"Sending session data for {session_id}")
-            emit('session_data', active_sessions[session_id])
+            if session_data["status"] == "queued":
+                session_data["queue_position"] = analysis_pool.position(session_id) or session_data.get("queue_position")
+            session_data["seq"] = seq
+            emit('session_data', session_data)
+        elif active_sessions.state(session_id) == EXPIRED:
+            logger.info(f"Requested data for expired session: {session_id}")
+            emit('session_data', {'session_id': session_id, 'status': 'expired'})
         else:
             logger.warning(f"Requested data for nonexistent session: {session_id}")
             emit('error', {'error': 'Session not found or expired'})
@@ -156,6 +568,12 @@ def get_session_data(data):
         logger.error(f"Error sending session data: {str(e)}")
         emit('error', {'error': 'Failed to retrieve session data'})
 
+@socketio.on('cancel_analysis')
+def handle_cancel_analysis(data):
+    session_id = (data or {}).get('session_id')
+    if not cancel_analysis(session_id, "requested by client"):
+        logger.info(f"Nothing to cancel for session {session_id}")
+
 @socketio.on('connect')
 def handle_connect():
     logger.info(f"Client connected: {request.sid}")
@@ -163,551 +581,509 @@ def handle_connect():
 @socketio.on('disconnect')
 def handle_disconnect():
     logger.info(f"Client disconnected: {request.sid}")
+    presence.leave(request.sid)
 
 # ----------------------------------------------------------------------
 # Analysis Process
 # ----------------------------------------------------------------------
 
-def run_analysis(session_id, company_name):
-    """Run the multi-agent analysis process"""
+def emit_to_session(session_id, event, payload):
+    """
+    Emit an event only to the clients that joined the session's room.
+    Every payload carries a server timestamp that clients use for pacing,
+    and all but transient events are logged and carry their seq.
+    """
+    payload = dict(payload, timestamp=time.time())
+    if event in TRANSIENT_EVENTS:
+        socketio.emit(event, payload, to=session_id)
+        return
+    # Held across the emit, so clients see the session's events in seq order
+    with session_emit_lock(session_id):
+        payload["seq"] = event_log.append(session_id, event, loggable_payload(session_id, payload))
+        socketio.emit(event, payload, to=session_id)
+
+def loggable_payload(session_id, payload):
+    """
+    The payload as kept in the event log: the session already stores the
+    research and summary texts, so the log only references them
+    """
+    logged = dict(payload)
+    for name in SESSION_TEXTS:
+        if logged.get(name):
+            logged[f"{name}_ref"] = text_ref(session_id, name, logged.pop(name))
+    return logged
+
+async def pace(seconds):
+    """Artificial delay between messages, only applied when SERVER_PACING is enabled"""
+    if SERVER_PACING:
+        await asyncio.sleep(seconds)
+
+def cancel_analysis(session_id, reason):
+    """
+    Stop a queued or running analysis. A queued one is dropped from the pool;
+    a running one stops at its next check and its in-flight LLM calls are
+    aborted. Returns False if there is nothing to cancel.
+    """
+    session = active_sessions.get(session_id)
+    if session is None or session["status"] in FINISHED_STATUSES:
+        return False
+    
+    logger.info(f"Cancelling analysis for session {session_id} ({reason})")
+    # Stored too, so a worker in another process stops at its next check
+    active_sessions.update(session_id, cancel_requested=True)
+    
+    if analysis_pool.cancel(session_id):
+        # It never started, so report the outcome here
+        presence.forget(session_id)
+        if checkpoints:
+            checkpoints.finish(session_id)
+        report_cancelled(session_id)
+        return True
+    
+    token = cancel_tokens.get(session_id)
+    if token is not None:
+        token.cancel()
+    return True
+
+def report_cancelled(session_id, timeline=None):
+    active_sessions.update(session_id, status="cancelled")
+    emit_to_session(session_id, 'status_update', {
+        'session_id': session_id,
+        'status': 'cancelled',
+        'message': "Analysis cancelled."
+    })
+    emit_to_session(session_id, 'analysis_complete', {
+        'session_id': session_id,
+        'status': 'cancelled',
+        'timeline': timeline or []
+    })
+
+def save_checkpoint(session_id, kind, data):
+    """Record a completed step; a failing checkpoint store must not stop the analysis"""
+    if not checkpoints:
+        return
     try:
-        logger.info(f"Starting analysis for {company_name} (session: {session_id})")
-        
-        # Initialize conversation state tracking
-        state = {
-            "current_speaker": None,
-            "current_speaking_to": None,
-            "current_question": None,
-            "last_response": None,
-            "next_speaker": None
+        checkpoints.append(session_id, kind, data)
+    except Exception as e:
+        logger.error(f"Error saving {kind} checkpoint for session {session_id}: {str(e)}")
+
+def resume_unfinished():
+    """
+    Keep the checkpoints of this process's analyses fresh, and take over
+    ones whose process has stopped, resuming each from its last step.
+    """
+    while True:
+        try:
+            checkpoints.heartbeat(analysis_pool.session_ids())
+            for analysis in checkpoints.claim_stale(CHECKPOINT_INTERVAL * 3, max_age=SESSION_TTL):
+                resume_analysis(**analysis)
+        except Exception as e:
+            logger.error(f"Error resuming unfinished analyses: {str(e)}")
+        time.sleep(CHECKPOINT_INTERVAL)
+
+def resume_analysis(session_id, company_name, options, started_at):
+    steps = checkpoints.steps(session_id)
+    logger.info(f"Resuming analysis for {company_name} (session: {session_id}) after {len(steps)} completed steps")
+    
+    # The session itself is gone if the in-memory store went down with the process
+    if session_id in active_sessions:
+        active_sessions.update(session_id, status="queued")
+    else:
+        active_sessions.create(session_id, {
+            "company_name": company_name,
+            "status": "queued",
+            "research_data": "",
+            "transcript": [],
+            "summary": "",
+            "options": options,
+            "started_at": started_at
+        })
+    try:
+        position = analysis_pool.submit(session_id, arun_analysis, session_id, company_name, options, steps)
+    except QueueFullError:
+        # The checkpoint stays unclaimed, so it is picked up again later
+        logger.warning(f"Queue full, postponing the resume of session {session_id}")
+        return
+    if position:
+        report_queue_positions([(session_id, position)])
+
+async def aanalyze_company(company_name, options, refresh=False):
+    """
+    Run one analysis to completion, for batches, and return its result.
+    Cached results are reused unless refresh is set, and research is shared
+    with other batches analyzing the same company.
+    """
+    variant = cache_variant(options)
+    cached_result = None
+    if result_cache and not refresh:
+        cached_result = await asyncio.to_thread(result_cache.get, company_name, variant)
+    if cached_result:
+        return {
+            "company_name": company_name,
+            "status": "complete",
+            "cached": True,
+            "research_data": cached_result["research_data"],
+            "transcript": cached_result["transcript"],
+            "summary": cached_result["summary"]
         }
+    
+    session_id = str(uuid.uuid4())
+    await asyncio.to_thread(active_sessions.create, session_id, {
+        "company_name": company_name,
+        "status": "queued",
+        "research_data": "",
+        "transcript": [],
+        "summary": "",
+        "options": options,
+        "started_at": time.time()
+    })
+    try:
+        await arun_analysis(session_id, company_name, options, shared_research=True)
+        session = await asyncio.to_thread(active_sessions.get, session_id) or {}
+    finally:
+        # The result goes to the batch output; keep the store for interactive sessions
+        await asyncio.to_thread(active_sessions.delete, session_id)
+        await asyncio.to_thread(event_log.delete, session_id)
+    
+    return {
+        "company_name": company_name,
+        "status": session.get("status", "error"),
+        "cached": False,
+        "research_data": session.get("research_data", ""),
+        "transcript": session.get("transcript", []),
+        "summary": session.get("summary", ""),
+        "error": session.get("error")
+    }
+
+def run_analysis(session_id, company_name, options=None, resume=None, shared_research=False):
+    """Run arun_analysis() from a thread outside the event loop and wait for it"""
+    run_sync(arun_analysis(session_id, company_name, options, resume=resume, shared_research=shared_research))
+
+async def arun_analysis(session_id, company_name, options=None, resume=None, shared_research=False):
+    """
+    Run the multi-agent analysis process with the settings from analysis_options().
+    With parallel_roundtable, the first-round opinions are requested from all
+    agents at once and the facilitator stitches them into the transcript.
+    With stream_responses, tokens are emitted as message_delta events while
+    each speaker is generating; the full message event follows as before.
+    The analysis stops between steps, aborting its LLM calls, once
+    cancel_analysis() has been called for the session.
+    Each completed step is checkpointed; resume is the list of checkpointed
+    (kind, data) steps of an analysis interrupted by a restart, which are
+    reused instead of being run again. With shared_research, the research is
+    shared with other analyses of the same company (see ResearchAgent.run_shared).
+    The analysis runs on the shared event loop; its session store writes,
+    emits and checkpoints go through one BlockingCalls queue, which keeps
+    them off the loop and in order.
+    """
+    options = options or analysis_options({})
+    
+    # Attribute every LLM call made for this analysis to the session
+    current_session.set(session_id)
+    if ANALYSIS_DEADLINE:
+        analysis_deadline.set(time.monotonic() + ANALYSIS_DEADLINE)
+    
+    # The stored flag catches cancellations from other processes, and ones
+    # made between leaving the queue and registering the token
+    token = CancellationToken(
+        check=lambda: (active_sessions.get(session_id) or {}).get("cancel_requested")
+    )
+    cancel_tokens[session_id] = token
+    analysis_cancel.set(token)
+    
+    blocking = BlockingCalls()
+    
+    def emit(event, payload):
+        return blocking.call(emit_to_session, session_id, event, payload)
+    
+    def update(**changes):
+        return blocking.call(active_sessions.update, session_id, **changes)
+    
+    # Step timings are saved with the session for the results waterfall
+    timeline = Timeline(on_change=lambda steps: blocking.post(active_sessions.update, session_id, timeline=steps))
+    session = await blocking.call(active_sessions.get, session_id)
+    if session and session.get("started_at"):
+        timeline.add("queued", "Waiting to resume" if resume else "Waiting in queue", session["started_at"], time.time())
+    
+    resume = resume or []
+    research_step = next((data for kind, data in resume if kind == "research"), None)
+    discussion_step = next((data for kind, data in resume if kind == "discussion"), None)
+    
+    def stream_to(speaker, to=None):
+        """Return a callback forwarding one speaker's tokens, or None when not streaming"""
+        if not options["stream_responses"]:
+            return None
+        
+        pending = []
+        flushed_at = 0.0
+        
+        def on_delta(delta):
+            # Compact format: tokens are batched, and a tail that never gets
+            # flushed is superseded by the full message or summary
+            nonlocal flushed_at
+            pending.append(delta)
+            now = time.monotonic()
+            if COMPACT_EVENTS and now - flushed_at < STREAM_FLUSH_SECONDS:
+                return
+            flushed_at = now
+            # Called on the event loop, so the emit (a broker publish with a
+            # message queue) is queued behind the analysis' other blocking calls
+            blocking.post(emit_to_session, session_id, 'message_delta', {
+                'session_id': session_id,
+                'speaker': speaker,
+                'to': to,
+                'delta': "".join(pending)
+            })
+            pending.clear()
+        return on_delta
+    
+    # Set once the deadline passes; the analysis then finishes as "partial"
+    partial = False
+    try:
+        if await blocking.call(token.is_cancelled, poll=True):
+            raise AnalysisCancelled("Analysis cancelled")
+        logger.info(f"Starting analysis for {company_name} (session: {session_id})")
         
         # Update the session status 
-        active_sessions[session_id]["status"] = "research"
+        await update(status="research")
         
         # Step 1: Research
-        socketio.emit('status_update', {
+        await emit('status_update', {
             'session_id': session_id,
             'status': 'research',
             'message': f"Researching {company_name}..."
         })
         
         try:
-            # Use the ResearchAgent to get data from web search
-            research_agent = ResearchAgent()
-            research_data = research_agent.run(company_name)
+            if research_step:
+                research_data = research_step["research_data"]
+            else:
+                # Use the ResearchAgent to get data from web search
+                phase_start = time.perf_counter()
+                research_agent = ResearchAgent()
+                try:
+                    with timeline.step("research", "Research"):
+                        if shared_research:
+                            research_data = await research_agent.arun_shared(company_name)
+                        else:
+                            research_data = await research_agent.arun(company_name)
+                except DeadlineExceeded:
+                    # Nothing to discuss; the discussion stops at its first check
+                    logger.warning(f"Analysis deadline reached while researching session {session_id}")
+                    research_data = ""
+                    partial = True
+                else:
+                    PHASE_LATENCY.observe(time.perf_counter() - phase_start, phase="research")
+                    await blocking.call(save_checkpoint, session_id, "research", {"research_data": research_data})
             
             # Update session and notify client
-            active_sessions[session_id]["research_data"] = research_data
-            active_sessions[session_id]["status"] = "discussion"
+            await update(research_data=research_data, status="discussion")
             
-            socketio.emit('research_complete', {
-                'session_id': session_id,
-                'research_data': research_data,
-                'company_name': company_name
-            })
+            research_event = {'session_id': session_id, 'company_name': company_name}
+            if COMPACT_EVENTS:
+                research_event['research_data_ref'] = text_ref(session_id, 'research_data', research_data)
+            else:
+                research_event['research_data'] = research_data
+            await emit('research_complete', research_event)
+        except AnalysisCancelled:
+            raise
         except Exception as e:
             error_message = f"Research phase failed: {str(e)}"
             logger.error(error_message)
             raise Exception(error_message)
         
         # Step 2: Agent Discussion
-        socketio.emit('status_update', {
+        await emit('status_update', {
             'session_id': session_id,
             'status': 'discussion',
             'message': "Starting expert discussion..."
         })
         
         try:
-            # Initialize all the agents
-            agents = {
-                "Business Strategist": BusinessStrategist(),
-                "Product Manager": ProductManager(),
-                "Technology Officer": TechnologyOfficer(),
-                "Innovation Analyst": InnovationAnalyst()
-            }
-            
-            # Initialize transcript
-            transcript = []
-            
-            # Initialize OpenAI client up front so it's available for the entire function
-            client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-            
-            # First analyze the research to determine which agent should start
-            facilitator_analysis_prompt = f"""
-            You are a discussion facilitator for a business technology analysis roundtable.
-            
-            Research about {company_name}:
-            
-            {research_data}
-            
-            Based on this research data about {company_name}, analyze the key themes and determine:
-            1. Which expert should begin our discussion (choose from: Business Strategist, Product Manager, Technology Officer, or Innovation Analyst)
-            2. A natural, conversational opening question that references a key insight from the research
-            3. Explain in 1-2 sentences why you've chosen this expert to begin
-            
-            Your opening question should be framed in a conversational way that references something specific from the research, such as:
-            The research shows that {company_name} is aiming to be a market leader in the Nordics. What do you think about this positioning in light of the data?
-            
-            Make the question sound natural, as if you're having a real conversation rather than an interview.
-            DO NOT include quotation marks around your question.
-            
-            Reply in this format exactly:
-            CHOSEN_EXPERT: [expert name]
-            QUESTION: [your conversational opening question that references the research - no quotation marks]
-            REASONING: [1-2 sentence explanation of your choice]
-            """
-            
-            # Use OpenAI to determine starting agent
-            try:
-                facilitator_response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant."},
-                        {"role": "user", "content": facilitator_analysis_prompt}
-                    ],
-                    temperature=0.7
-                )
-                facilitator_choice = facilitator_response.choices[0].message.content.strip()
-                
-                # Extract chosen expert and question
-                chosen_expert = None
-                opening_question = None
-                reasoning = None
-                
-                for line in facilitator_choice.split('\n'):
-                    if line.startswith('CHOSEN_EXPERT:'):
-                        chosen_expert = line.replace('CHOSEN_EXPERT:', '').strip()
-                    elif line.startswith('QUESTION:'):
-                        opening_question = line.replace('QUESTION:', '').strip()
-                        # Clean any quotation marks that might have been included
-                        opening_question = clean_quotation_marks(opening_question)
-                    elif line.startswith('REASONING:'):
-                        reasoning = line.replace('REASONING:', '').strip()
-                
-                # Fallback if parsing failed
-                if not chosen_expert or chosen_expert not in agents:
-                    chosen_expert = "Business Strategist"
-                    opening_question = f"The research shows that {company_name} is positioning itself as a leader in business technology transformation in the Nordics. What do you think about this positioning based on the data we have?"
-                    reasoning = "Business strategy provides a foundational perspective to start our discussion."
-                
-            except Exception as e:
-                logger.error(f"Error in facilitator choice: {str(e)}")
-                chosen_expert = "Business Strategist"
-                opening_question = f"The research shows that {company_name} is positioning itself in the market. What are your thoughts on their business strategy based on what we've learned?"
-                reasoning = "Starting with business strategy as a foundation for our discussion."
-            
-            # Round 1 header
-            round_header = "\n=== Expert Discussion - Round 1 ==="
-            logger.info(round_header)
-            transcript.append(round_header)
-            
-            socketio.emit('round_update', {
-                'session_id': session_id,
-                'round': 1,
-                'message': round_header
-            })
-            
-            # Function to generate a natural follow-up question
-            def generate_follow_up_question(current_agent, current_response, next_agent):
-                prompt = f"""
-                You are a skilled facilitator running a business technology roundtable discussion about {company_name}.
-                
-                The {current_agent} just said:
-                
-                "{current_response}"
-                
-                Now you need to ask the {next_agent} a follow-up question that:
-                1. Naturally builds on a specific insight from {current_agent}'s response
-                2. Is tailored to the {next_agent}'s specific expertise and perspective
-                3. Maintains conversation flow like in a real roundtable discussion
-                
-                Structure your question like a natural conversation, for example:
-                - That's an interesting point about [specific insight]. From your perspective as {next_agent}, how would this affect...?
-                - {current_agent} mentioned [specific insight]. How does this align with what you've seen in terms of...?
-                - Building on what we just heard about [specific insight], what's your take on how this impacts...?
-                
-                IMPORTANT: DO NOT use quotation marks in your response.
-                Write ONLY the question you would ask the {next_agent} - nothing else, no preamble, no quotation marks.
-                The ideal length is 1-2 sentences, maximum 30 words.
-                """
-                
-                try:
-                    follow_up_response = client.chat.completions.create(
-                        model="gpt-4o",
-                        messages=[
-                            {"role": "system", "content": "You are a skilled discussion facilitator."},
-                            {"role": "user", "content": prompt}
-                        ],
-                        temperature=0.7,
-                        max_tokens=100  # Keep it concise
-                    )
-                    follow_up = follow_up_response.choices[0].message.content.strip()
-                    
-                    # Clean any quotation marks that might have been included
-                    follow_up = clean_quotation_marks(follow_up)
-                    
-                    # Ensure it ends with a question mark
-                    if not follow_up.endswith('?'):
-                        follow_up += '?'
-                        
-                    return follow_up
-                except Exception as e:
-                    logger.error(f"Error generating follow-up question: {str(e)}")
-                    # Fallback to a generic follow-up
-                    return f"Based on what we just heard, what's your perspective as a {next_agent}?"
-            
-            # First round discussion order - start with chosen expert, then go through remaining ones
-            remaining_agents = list(agents.keys())
-            remaining_agents.remove(chosen_expert)
-            round_one_order = [chosen_expert] + remaining_agents
-            
-            # Store agent responses for reference
-            agent_responses = {}
-            
-            # First round of discussion
-            for i, agent_name in enumerate(round_one_order):
-                agent = agents[agent_name]
-                
-                # First agent gets the opening question
-                if i == 0:
-                    # Opening statement from facilitator with reasoning
-                    opening_statement = f"Let's begin our analysis of {company_name}. {opening_question}"
-                    facilitator_text = f"Facilitator (to {agent_name}): {opening_statement}"
-                    question = opening_question
-                else:
-                    # For subsequent agents, generate a natural follow-up based on previous response
-                    prev_agent = round_one_order[i-1]
-                    prev_response = agent_responses.get(prev_agent, "")
-                    
-                    # Generate follow-up question
-                    question = generate_follow_up_question(prev_agent, prev_response, agent_name)
-                    facilitator_text = f"Facilitator (to {agent_name}): {question}"
-                
-                logger.info(facilitator_text)
-                transcript.append(facilitator_text)
-                
-                # Update state tracking
-                state["current_speaker"] = "Facilitator"
-                state["current_speaking_to"] = agent_name
-                state["current_question"] = question
-                state["next_speaker"] = agent_name
-                
-                # Emit facilitator message
-                socketio.emit('message', {
-                    'session_id': session_id,
-                    'speaker': 'Facilitator',
-                    'to': agent_name,
-                    'message': question,
-                    'conversation_state': state
-                })
-                time.sleep(1)  # Short delay for UI
-                
-                # Get agent response
-                agent_input = f"""
-                Research about {company_name}:
-                
-                {research_data}
-                
-                Previous discussion (if any):
-                {transcript_text if 'transcript_text' in locals() else 'This is the start of our discussion.'}
-                
-                Question: {question}
-                """
-                response = agent.get_response(agent_input)
-                
-                # Store response
-                agent_responses[agent_name] = response
-                
-                # Add to transcript
-                agent_text = f"{agent_name}: {response}"
-                logger.info(f"Generated response for {agent_name}")
-                transcript.append(agent_text)
-                transcript.append("")  # Empty line for spacing
-                
-                # Update state tracking
-                state["current_speaker"] = agent_name
-                state["current_speaking_to"] = None
-                state["last_response"] = response[:100] + "..." if len(response) > 100 else response
-                
-                # Calculate who's next in the order
-                if i < len(round_one_order) - 1:
-                    state["next_speaker"] = round_one_order[i+1]
-                else:
-                    state["next_speaker"] = None
-                
-                # Emit agent message
-                socketio.emit('message', {
-                    'session_id': session_id,
-                    'speaker': agent_name,
-                    'message': response,
-                    'conversation_state': state
-                })
-                time.sleep(2)  # Delay to allow reading
-                
-                # Store response for generating future questions
-                agent_responses[agent_name] = response
-            
-            # Join transcript to provide context for round 2
-            transcript_text = "\n".join(transcript)
-            
-            # Round 2 header
-            round_header = "\n=== Expert Discussion - Round 2 ==="
-            logger.info(round_header)
-            transcript.append(round_header)
-            
-            socketio.emit('round_update', {
-                'session_id': session_id,
-                'round': 2,
-                'message': round_header
-            })
-            
-            # Generate focused round 2 order and questions using OpenAI
-            round_two_prompt = f"""
-            Based on the first round of discussion about {company_name}:
-            
-            {transcript_text}
-            
-            As a facilitator, determine:
-            1. Which expert should lead the second round (may be different from round 1)
-            2. A specific follow-up theme or question that builds on the first round
-            3. A suggested order for the remaining experts that creates a natural flow
-            
-            DO NOT use quotation marks in your responses.
-            
-            Reply in this format exactly:
-            LEAD_EXPERT: [expert name]
-            THEME: [concise theme or question for round 2 - no quotation marks]
-            ORDER: [comma-separated list of the remaining experts in suggested order]
-            """
-            
-            try:
-                facilitator_response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant."},
-                        {"role": "user", "content": round_two_prompt}
-                    ],
-                    temperature=0.7
-                )
-                round_two_plan = facilitator_response.choices[0].message.content.strip()
-                
-                # Parse the response
-                lead_expert = None
-                theme = None
-                expert_order = []
-                
-                for line in round_two_plan.split('\n'):
-                    if line.startswith('LEAD_EXPERT:'):
-                        lead_expert = line.replace('LEAD_EXPERT:', '').strip()
-                    elif line.startswith('THEME:'):
-                        theme = line.replace('THEME:', '').strip()
-                        # Clean any quotation marks
-                        theme = clean_quotation_marks(theme)
-                    elif line.startswith('ORDER:'):
-                        order_str = line.replace('ORDER:', '').strip()
-                        expert_order = [name.strip() for name in order_str.split(',') if name.strip() in agents]
-                
-                # Fallback if parsing failed
-                if not lead_expert or lead_expert not in agents or not theme:
-                    lead_expert = list(agents.keys())[0]
-                    theme = f"Let's focus on implementation challenges and opportunities for {company_name}."
-                    expert_order = [name for name in agents.keys() if name != lead_expert]
-                
-                # Ensure the order has all remaining experts
-                for name in agents.keys():
-                    if name != lead_expert and name not in expert_order:
-                        expert_order.append(name)
-                
-            except Exception as e:
-                logger.error(f"Error in round two planning: {str(e)}")
-                # Fallback order
-                lead_expert = "Technology Officer"
-                theme = f"Let's explore implementation challenges and opportunities for {company_name}."
-                expert_order = [name for name in agents.keys() if name != lead_expert]
-            
-            # Second round discussion with dynamic questions
-            round_two_order = [lead_expert] + expert_order
-            
-            for i, agent_name in enumerate(round_two_order):
-                agent = agents[agent_name]
-                
-                # Formulate a conversational question
-                if i == 0:
-                    # Make sure theme has no quotation marks
-                    theme = clean_quotation_marks(theme)
-                    facilitator_text = f"Facilitator (to {agent_name}): Moving to our second round of discussion. {theme} What's your perspective on this?"
-                    question = f"{theme} What's your perspective on this?"
-                else:
-                    # Generate follow-up based on previous response
-                    prev_agent = round_two_order[i-1]
-                    prev_response = agent_responses.get(prev_agent, "")
-                    
-                    # Generate follow-up question
-                    question = generate_follow_up_question(prev_agent, prev_response, agent_name)
-                    facilitator_text = f"Facilitator (to {agent_name}): {question}"
-                
-                logger.info(facilitator_text)
-                transcript.append(facilitator_text)
-                
-                # Update state tracking
-                state["current_speaker"] = "Facilitator"
-                state["current_speaking_to"] = agent_name
-                state["current_question"] = question
-                state["next_speaker"] = agent_name
-                
-                # Emit facilitator message
-                socketio.emit('message', {
-                    'session_id': session_id,
-                    'speaker': 'Facilitator',
-                    'to': agent_name,
-                    'message': question,
-                    'conversation_state': state
-                })
-                time.sleep(1)  # Short delay for UI
-                
-                # Get agent response with full context
-                agent_input = f"""
-                Research about {company_name}:
-                
-                {research_data}
-                
-                Previous discussion:
-                
-                {transcript_text}
-                
-                Question: {question}
-                
-                Your previous response in round 1:
-                {agent_responses.get(agent_name, "You haven't spoken yet in this discussion.")}
-                
-                Please build on the discussion rather than repeating points. Respond directly to the question.
-                """
-                response = agent.get_response(agent_input)
-                
-                # Add to transcript
-                agent_text = f"{agent_name}: {response}"
-                logger.info(f"Generated response for {agent_name}")
-                transcript.append(agent_text)
-                transcript.append("")  # Empty line for spacing
-                
-                # Update state tracking
-                state["current_speaker"] = agent_name
-                state["current_speaking_to"] = None
-                state["last_response"] = response[:100] + "..." if len(response) > 100 else response
-                
-                # Calculate who's next in the order
-                if i < len(round_two_order) - 1:
-                    state["next_speaker"] = round_two_order[i+1]
-                else:
-                    state["next_speaker"] = None
-                
-                # Emit agent message
-                socketio.emit('message', {
-                    'session_id': session_id,
-                    'speaker': agent_name,
-                    'message': response,
-                    'conversation_state': state
-                })
-                time.sleep(2)  # Delay to allow reading
-                
-                # Store response for generating future questions
-                agent_responses[agent_name] = response
+            phase_start = time.perf_counter()
+            engine = DiscussionEngine(
+                company_name,
+                research_data,
+                create_agents(options["experts"]),
+                facilitator=LLMFacilitator(check_consensus=options["stop_on_consensus"]),
+                rounds=options["rounds"],
+                parallel_first_round=options["parallel_roundtable"],
+                round_budget=options["round_budget"],
+                emit=lambda event, payload: emit(event, dict(payload, session_id=session_id)),
+                state_deltas=COMPACT_EVENTS,
+                stream_to=stream_to,
+                pace=pace,
+                timeline=timeline,
+                checkpoint=lambda kind, data: blocking.call(save_checkpoint, session_id, kind, data)
+            )
+            engine.restore(resume)
+            if discussion_step:
+                transcript = engine.transcript
+                engine.stop_reason = discussion_step["stop_reason"]
+            else:
+                transcript = await engine.arun()
+                await blocking.call(save_checkpoint, session_id, "discussion", {"stop_reason": engine.stop_reason})
+            PHASE_LATENCY.observe(time.perf_counter() - phase_start, phase="discussion")
+            logger.info(
+                f"Discussion finished after {engine.rounds_completed} of {engine.rounds} rounds "
+                f"({engine.skipped_turns} turns skipped for time, stop reason: {engine.stop_reason})"
+            )
+            partial = partial or engine.stop_reason == "deadline"
             
             # Update session with transcript
-            active_sessions[session_id]["transcript"] = transcript
-            active_sessions[session_id]["status"] = "summarizing"
+            await update(transcript=transcript.lines(), status="summarizing")
             
+        except AnalysisCancelled:
+            raise
         except Exception as e:
             error_message = f"Discussion phase failed: {str(e)}"
             logger.error(error_message)
             raise Exception(error_message)
         
         # Step 3: Generate Summary
-        socketio.emit('status_update', {
+        await emit('status_update', {
             'session_id': session_id,
             'status': 'summarizing',
             'message': "Creating executive summary..."
         })
         
         try:
-            # Join transcript for summarization
-            transcript_text = "\n".join(transcript)
+            if await blocking.call(token.is_cancelled, poll=True):
+                raise AnalysisCancelled("Analysis cancelled")
+            
+            # The summarizer gets the full transcript
+            transcript_text = transcript.text()
             
             # Generate summary
+            phase_start = time.perf_counter()
             summarizer = SummarizationAgent()
-            summary = summarizer.summarize(research_data, transcript_text)
+            with timeline.step("summary", "Executive summary"):
+                if not partial:
+                    try:
+                        summary = await summarizer.asummarize(research_data, transcript_text, on_delta=stream_to('Summary'))
+                    except DeadlineExceeded:
+                        logger.warning(f"Analysis deadline reached while summarizing session {session_id}")
+                        partial = True
+                if partial and not (research_data or transcript.turns):
+                    summary = fallback_summary(research_data, transcript)
+                elif partial:
+                    # Out of time: a short summary of what exists, within a small grace period
+                    analysis_deadline.set(time.monotonic() + SUMMARY_GRACE_SECONDS)
+                    try:
+                        summary = await summarizer.asummarize(
+                            research_data, transcript_text, on_delta=stream_to('Summary'), brief=True
+                        )
+                    except DeadlineExceeded:
+                        logger.warning(f"Short summary for session {session_id} ran past its grace period")
+                        summary = fallback_summary(research_data, transcript)
+            PHASE_LATENCY.observe(time.perf_counter() - phase_start, phase="summary")
             
             # Update session data
-            active_sessions[session_id]["summary"] = summary
-            active_sessions[session_id]["status"] = "complete"
+            status = "partial" if partial else "complete"
+            await update(summary=summary, status=status)
+            
+            # Cache the result unless it was cut short or an agent fell back to an error message
+            failed = partial or summary.startswith("Summary generation failed") or any(
+                "[Error generating response from" in turn.text for turn in transcript.turns
+            )
+            if result_cache and not failed:
+                try:
+                    await blocking.call(result_cache.put, company_name, {
+                        "research_data": research_data,
+                        "transcript": transcript.lines(),
+                        "summary": summary
+                    }, variant=cache_variant(options))
+                except Exception as e:
+                    logger.error(f"Error caching analysis result: {str(e)}")
             
             # Emit completion events
             logger.info(f"Analysis complete, emitting completion events for session {session_id}")
             
             # First notification
-            socketio.emit('status_update', {
+            await emit('status_update', {
                 'session_id': session_id,
-                'status': 'complete',
-                'message': "Analysis complete. Preparing results..."
+                'status': status,
+                'message': "Time limit reached, showing a shortened analysis. Preparing results..." if partial
+                           else "Analysis complete. Preparing results..."
             })
             
-            # Main completion event
-            socketio.emit('analysis_complete', {
-                'session_id': session_id,
-                'summary': summary
-            })
-            
-            # Sleep briefly
-            time.sleep(1)
-            
-            # Backup notification in case the first wasn't received
-            socketio.emit('analysis_complete', {
-                'session_id': session_id,
-                'summary': summary
-            })
+            # Main completion event; clients that miss it get it replayed on reconnect
+            complete_event = {'session_id': session_id, 'status': status, 'timeline': timeline.to_list()}
+            if COMPACT_EVENTS and summary:
+                # Streaming clients already have the text; the others fetch it once
+                complete_event['summary_ref'] = text_ref(session_id, 'summary', summary)
+            else:
+                complete_event['summary'] = summary
+            await emit('analysis_complete', complete_event)
             
             logger.info(f"Analysis successfully completed for session {session_id}")
             
+        except AnalysisCancelled:
+            raise
         except Exception as e:
             error_message = f"Summary generation failed: {str(e)}"
             logger.error(error_message)
             raise Exception(error_message)
             
+    except AnalysisCancelled:
+        logger.info(f"Analysis cancelled for session {session_id}")
+        await blocking.call(report_cancelled, session_id, timeline.to_list())
+    
     except Exception as e:
         error_message = str(e)
         logger.error(f"Error during analysis: {error_message}")
         
         # Update session with error
-        if session_id in active_sessions:
-            active_sessions[session_id]["status"] = "error"
-            active_sessions[session_id]["error"] = error_message
+        await update(status="error", error=error_message)
         
         # Emit error to client - try multiple approaches for reliability
         try:
             # Direct emit
-            socketio.emit('error', {
+            await emit('error', {
                 'session_id': session_id,
                 'error': error_message
             })
             
             # Also emit a status update
-            socketio.emit('status_update', {
+            await emit('status_update', {
                 'session_id': session_id,
                 'status': 'error',
                 'message': f"Error: {error_message}"
             })
             
             # Even if there's an error, we might still want to redirect to results
-            socketio.emit('analysis_complete', {
+            await emit('analysis_complete', {
                 'session_id': session_id,
                 'error': error_message,
                 'status': 'error'
             })
         except Exception as emit_error:
             logger.critical(f"Failed to emit error event: {str(emit_error)}")
+    
+    finally:
+        cancel_tokens.pop(session_id, None)
+        presence.forget(session_id)
+        if checkpoints:
+            try:
+                await blocking.call(checkpoints.finish, session_id)
+            except Exception as e:
+                logger.error(f"Error removing checkpoint for session {session_id}: {str(e)}")
+        await blocking.join()
+
+def start_checkpoint_resumer():
+    """
+    Start the thread that runs resume_unfinished(). Only a process that
+    serves clients should call this (the __main__ block below, or a WSGI
+    server's worker startup hook), never code that merely imports the app.
+    """
+    if not checkpoints:
+        return
+    threading.Thread(target=resume_unfinished, name="checkpoint-resumer", daemon=True).start()
 
 if __name__ == '__main__':
+    # Not in the parent process of the debug reloader, which serves no clients
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_checkpoint_resumer()
     try:
         # Use parameters compatible with your Flask-SocketIO version
         logger.info("Starting BTModel Web - MVP with AI Agents")
@@ -0,0 +1,281 @@
+# batch.py
+
+"""
+Batch analyses of many companies, e.g. a portfolio analyzed overnight.
+
+Run with: python batch.py companies.csv --output results.jsonl
+          python batch.py companies.json --output results.jsonl --rounds 3
+
+The input is a CSV file with a company_name (or company, or first) column,
+or a JSON list of names or of objects with a company_name field. Results are
+appended to the output as one JSON line per company as soon as it finishes.
+The same batches can be started over HTTP with POST /batch_analysis.
+"""
+
+import argparse
+import asyncio
+import csv
+import io
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from analysis_pool import AnalysisPool, QueueFullError
+from result_cache import normalize_company_name
+
+# Set up logging
+logger = logging.getLogger('btmodel-web')
+
+# Batch analyses run in a pool of their own, so they cannot starve interactive users
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", "2"))
+BATCH_MAX_COMPANIES = int(os.environ.get("BATCH_MAX_COMPANIES", "500"))
+BATCH_OUTPUT_DIR = os.environ.get("BATCH_OUTPUT_DIR", "batches")
+# Seconds a finished batch's progress stays available; its output file is kept
+BATCH_JOB_TTL = float(os.environ.get("BATCH_JOB_TTL", str(24 * 3600)))
+
+def read_companies(text, filename=""):
+    """Parse a CSV or JSON company list into a list of names"""
+    text = text.strip()
+    if filename.lower().endswith(".json") or text.startswith(("[", "{")):
+        data = json.loads(text)
+        if isinstance(data, dict):
+            data = data.get("companies", [])
+        names = [item.get("company_name", "") if isinstance(item, dict) else str(item) for item in data]
+    else:
+        rows = list(csv.reader(io.StringIO(text)))
+        header = [cell.strip().lower() for cell in rows[0]] if rows else []
+        column = next((header.index(name) for name in ("company_name", "company") if name in header), None)
+        if column is None:
+            # No recognised header: every row is a company in the first column
+            column = 0
+        else:
+            rows = rows[1:]
+        names = [row[column] for row in rows if len(row) > column]
+    return [name.strip() for name in names if name and name.strip()]
+
+def dedupe_companies(names):
+    """
+    Merge names that normalize to the same company, keeping the first
+    spelling. Returns {name: [other spellings]} in input order.
+    """
+    companies = {}
+    first_spelling = {}
+    for name in names:
+        key = normalize_company_name(name)
+        if key not in first_spelling:
+            first_spelling[key] = name
+            companies[name] = []
+        elif name != first_spelling[key]:
+            companies[first_spelling[key]].append(name)
+    return companies
+
+# ---------------------------
+# Batch Job
+# ---------------------------
+class BatchJob:
+    """One batch: its companies, the JSONL file results go to, and progress counters"""
+
+    def __init__(self, job_id, companies, options, output_path, refresh=False, submitted=None):
+        self.id = job_id
+        self.companies = companies
+        self.options = options
+        # Analyze again even if a cached result exists
+        self.refresh = refresh
+        self.output_path = output_path
+        self.submitted = submitted if submitted is not None else len(companies)
+        self.completed = 0
+        self.failed = 0
+        self.cached = 0
+        self.started_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+        # Start a fresh output file, so a finished batch has exactly one line per company
+        directory = os.path.dirname(output_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        open(output_path, "w").close()
+
+    def record(self, result):
+        """Append one company's result to the output and update the counters"""
+        with self._lock:
+            with open(self.output_path, "a") as output:
+                output.write(json.dumps(result) + "\n")
+            self.completed += 1
+            if result["status"] not in ("complete", "partial"):
+                self.failed += 1
+            if result.get("cached"):
+                self.cached += 1
+            if self.completed == len(self.companies):
+                self.finished_at = time.time()
+
+    def progress(self):
+        with self._lock:
+            elapsed = (self.finished_at or time.time()) - self.started_at
+            remaining = len(self.companies) - self.completed
+            return {
+                "batch_id": self.id,
+                "status": "complete" if self.finished_at else "running",
+                "submitted": self.submitted,
+                "companies": len(self.companies),
+                "completed": self.completed,
+                "failed": self.failed,
+                "cached": self.cached,
+                "elapsed_seconds": round(elapsed, 1),
+                # Extrapolated from the companies finished so far
+                "eta_seconds": round(elapsed / self.completed * remaining, 1) if self.completed and remaining else None,
+                "output": self.output_path
+            }
+
+# ---------------------------
+# Batch Runner
+# ---------------------------
+class BatchRunner:
+    """
+    Runs batches on a bounded worker pool of their own. The coroutine
+    analyze(company_name, options, refresh) does one analysis and returns
+    its result dict; companies from every batch wait in one queue and are
+    analyzed in submission order. Finished batches are forgotten job_ttl
+    seconds after their last company.
+    """
+
+    def __init__(self, analyze, max_workers=BATCH_CONCURRENCY, max_companies=BATCH_MAX_COMPANIES,
+                 output_dir=BATCH_OUTPUT_DIR, on_progress=None, job_ttl=BATCH_JOB_TTL):
+        self.analyze = analyze
+        self.max_companies = max_companies
+        self.output_dir = output_dir
+        # Called with the job's progress dict after every company
+        self.on_progress = on_progress
+        self.job_ttl = job_ttl
+        self.jobs = {}
+        self.pool = AnalysisPool(max_workers=max_workers, max_queue=max_companies)
+        # Held from the capacity check until every company is queued
+        self._lock = threading.Lock()
+
+    def get(self, job_id):
+        """The batch with the given id, or None if it is unknown or expired"""
+        with self._lock:
+            self._prune()
+            return self.jobs.get(job_id)
+
+    def _prune(self):
+        expired = time.time() - self.job_ttl
+        for job_id, job in list(self.jobs.items()):
+            if job.finished_at is not None and job.finished_at < expired:
+                del self.jobs[job_id]
+
+    def submit(self, names, options, output_path=None, refresh=False):
+        """
+        Start a batch for a list of company names. Raises ValueError for an
+        empty or oversized list and QueueFullError if earlier batches leave
+        no room for this one.
+        """
+        companies = dedupe_companies(names)
+        if not companies:
+            raise ValueError("No company names found")
+        if len(companies) > self.max_companies:
+            raise ValueError(f"A batch can have at most {self.max_companies} companies")
+
+        with self._lock:
+            self._prune()
+            if self.pool.stats()["queued"] + len(companies) > self.max_companies:
+                raise QueueFullError("Too many batch analyses are already waiting")
+
+            job_id = str(uuid.uuid4())
+            output_path = output_path or os.path.join(self.output_dir, f"{job_id}.jsonl")
+            job = BatchJob(job_id, companies, options, output_path, refresh=refresh, submitted=len(names))
+            self.jobs[job.id] = job
+
+            logger.info(
+                f"Batch {job.id}: {len(companies)} companies ({len(names) - len(companies)} duplicates merged), "
+                f"results in {job.output_path}"
+            )
+            queued = []
+            try:
+                for index, company_name in enumerate(companies):
+                    self.pool.submit(f"{job.id}:{index}", self._run_one, job, company_name)
+                    queued.append(f"{job.id}:{index}")
+            except Exception:
+                # Take back the companies that have not started, so a failed
+                # submit does not leave most of a forgotten batch queued
+                for session_id in queued:
+                    self.pool.cancel(session_id)
+                del self.jobs[job.id]
+                raise
+        return job
+
+    async def _run_one(self, job, company_name):
+        start = time.time()
+        try:
+            result = await self.analyze(company_name, job.options, job.refresh)
+        except asyncio.CancelledError:
+            # Still counted, otherwise the batch never finishes; recorded
+            # right here since the cancelled task should not await again
+            logger.error(f"Batch {job.id}: analysis of {company_name} was cancelled")
+            job.record({
+                "company_name": company_name, "status": "cancelled", "error": "Analysis was cancelled",
+                "aliases": job.companies[company_name], "seconds": round(time.time() - start, 1)
+            })
+            raise
+        except Exception as e:
+            logger.error(f"Batch {job.id}: analysis of {company_name} failed: {str(e)}")
+            result = {"company_name": company_name, "status": "error", "error": str(e)}
+        result["aliases"] = job.companies[company_name]
+        result["seconds"] = round(time.time() - start, 1)
+        await asyncio.to_thread(job.record, result)
+
+        progress = job.progress()
+        logger.info(f"Batch {job.id}: {progress['completed']}/{progress['companies']} companies analyzed")
+        if self.on_progress:
+            try:
+                await asyncio.to_thread(self.on_progress, progress)
+            except Exception as e:
+                logger.error(f"Error reporting batch progress: {str(e)}")
+
+# ---------------------------
+# Command Line
+# ---------------------------
+def main():
+    parser = argparse.ArgumentParser(description="Analyze a list of companies in one batch")
+    parser.add_argument("input", help="CSV or JSON file with the company names")
+    parser.add_argument("--output", required=True, help="JSONL file the results are written to")
+    parser.add_argument("--workers", type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument("--rounds", type=int)
+    parser.add_argument("--experts", help="Comma-separated expert names")
+    parser.add_argument("--parallel", action="store_true", help="Use the parallel roundtable")
+    parser.add_argument("--stop-on-consensus", action="store_true")
+    parser.add_argument("--refresh", action="store_true", help="Ignore cached results")
+    args = parser.parse_args()
+
+    with open(args.input) as source:
+        names = read_companies(source.read(), args.input)
+
+    # The CLI's sessions live only as long as it runs, so they are not
+    # checkpointed, and it must not resume the server's analyses either
+    os.environ["CHECKPOINT_PATH"] = ""
+    # Imported here so the app can import this module
+    import app as app_module
+
+    options = app_module.analysis_options({
+        "rounds": args.rounds,
+        "experts": args.experts,
+        "parallel_roundtable": "1" if args.parallel else "",
+        "stop_on_consensus": "1" if args.stop_on_consensus else ""
+    })
+
+    runner = BatchRunner(app_module.aanalyze_company, max_workers=args.workers, max_companies=max(len(names), 1))
+    job = runner.submit(names, options, args.output, refresh=args.refresh)
+    while True:
+        time.sleep(5)
+        progress = job.progress()
+        eta = f", about {progress['eta_seconds'] / 60:.0f} min left" if progress["eta_seconds"] else ""
+        print(f"{progress['completed']}/{progress['companies']} done, {progress['failed']} failed{eta}", flush=True)
+        if progress["status"] == "complete":
+            break
+    print(f"Results written to {job.output_path}")
+
+if __name__ == '__main__':
+    main()
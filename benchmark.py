@@ -0,0 +1,415 @@
+# benchmark.py
+
+"""
+Small load benchmarks for BTModel Web.
+
+Run with: python benchmark.py fanout --sessions 50
+          python benchmark.py sessions --count 10000
+          python benchmark.py throughput --sessions 20 --workers 4
+          python benchmark.py wire --rounds 2
+          python benchmark.py wire-check --max-bytes 60000
+
+The throughput benchmark uses the offline LLM and search stand-ins from
+fake_backend.py unless LLM_BACKEND / SEARCH_BACKEND say otherwise.
+"""
+
+import argparse
+import gc
+import json
+import os
+import resource
+import statistics
+import time
+import uuid
+import zlib
+
+os.environ.setdefault("OPENAI_API_KEY", "benchmark-placeholder")
+os.environ.setdefault("LLM_BACKEND", "fake")
+os.environ.setdefault("SEARCH_BACKEND", "fake")
+# Benchmark sessions are throwaway; do not leave them behind to be resumed
+os.environ.setdefault("CHECKPOINT_PATH", "")
+
+import app as app_module
+from app import app, socketio, active_sessions, report_queue_positions
+from analysis_pool import AnalysisPool
+from session_store import InMemorySessionStore
+
+# A representative event sequence for one analysis, with payload sizes close
+# to what run_analysis produces (research blob, agent answers, summary)
+RESEARCH_TEXT = "Research paragraph about the company. " * 80
+RESPONSE_TEXT = "An expert opinion about the company strategy. " * 30
+SUMMARY_TEXT = "Executive summary section content. " * 120
+
+def analysis_events(session_id):
+    """Return the (event, payload) pairs emitted during one analysis"""
+    state = {
+        "current_speaker": "Business Strategist",
+        "current_speaking_to": None,
+        "current_question": "What do you think about this positioning?",
+        "last_response": RESPONSE_TEXT[:100] + "...",
+        "next_speaker": "Product Manager"
+    }
+    events = [
+        ('status_update', {'session_id': session_id, 'status': 'research', 'message': "Researching..."}),
+        ('research_complete', {'session_id': session_id, 'research_data': RESEARCH_TEXT, 'company_name': "Benchmark Oy"}),
+        ('round_update', {'session_id': session_id, 'round': 1, 'message': "\n=== Expert Discussion - Round 1 ==="}),
+    ]
+    for _ in range(8):
+        events.append(('message', {'session_id': session_id, 'speaker': 'Facilitator', 'to': 'Product Manager',
+                                   'message': state["current_question"], 'conversation_state': state}))
+        events.append(('message', {'session_id': session_id, 'speaker': 'Product Manager',
+                                   'message': RESPONSE_TEXT, 'conversation_state': state}))
+    events.append(('analysis_complete', {'session_id': session_id, 'summary': SUMMARY_TEXT}))
+    return events
+
+def connect_clients(session_count):
+    """Create one Socket.IO test client per session and join it to its room"""
+    clients = []
+    for i in range(session_count):
+        session_id = f"bench-{i}"
+        active_sessions.create(session_id, {
+            "company_name": "Benchmark Oy",
+            "status": "discussion",
+            "research_data": "",
+            "transcript": [],
+            "summary": "",
+            "started_at": time.time()
+        })
+        client = socketio.test_client(app)
+        client.emit('get_session_data', {'session_id': session_id})
+        client.get_received()
+        clients.append((session_id, client))
+    return clients
+
+def run_fanout(clients, use_rooms):
+    """Emit every session's events and measure delivered bytes and emit latency"""
+    latencies = []
+    for session_id, _ in clients:
+        for event, payload in analysis_events(session_id):
+            start = time.perf_counter()
+            if use_rooms:
+                socketio.emit(event, payload, to=session_id)
+            else:
+                socketio.emit(event, payload)
+            latencies.append(time.perf_counter() - start)
+
+    delivered_bytes = 0
+    delivered_events = 0
+    for _, client in clients:
+        for packet in client.get_received():
+            delivered_bytes += len(json.dumps(packet['args']))
+            delivered_events += 1
+
+    return {
+        "delivered_events": delivered_events,
+        "delivered_bytes": delivered_bytes,
+        "emit_p50_ms": statistics.median(latencies) * 1000,
+        "emit_p95_ms": statistics.quantiles(latencies, n=20)[-1] * 1000,
+        "total_seconds": sum(latencies)
+    }
+
+def benchmark_fanout(args):
+    clients = connect_clients(args.sessions)
+    try:
+        results = {
+            "broadcast": run_fanout(clients, use_rooms=False),
+            "rooms": run_fanout(clients, use_rooms=True)
+        }
+    finally:
+        for session_id, client in clients:
+            client.disconnect()
+            active_sessions.delete(session_id)
+
+    print(f"Fan-out benchmark with {args.sessions} concurrent sessions")
+    for mode, result in results.items():
+        print(
+            f"  {mode:<10} events={result['delivered_events']:<8} "
+            f"bytes={result['delivered_bytes']:<11} "
+            f"emit p50={result['emit_p50_ms']:.3f}ms p95={result['emit_p95_ms']:.3f}ms "
+            f"total={result['total_seconds']:.2f}s"
+        )
+
+def current_rss_mb():
+    """Resident set size of this process in MB (current on Linux, peak elsewhere)"""
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def completed_session(index):
+    """A completed session with payload sizes close to a real analysis"""
+    transcript = []
+    for turn in range(8):
+        transcript.append(f"Facilitator (to Product Manager): Question {turn} for session {index}?")
+        transcript.append(f"Product Manager: {RESPONSE_TEXT} ({index}/{turn})")
+        transcript.append("")
+    return {
+        "company_name": f"Company {index}",
+        "status": "complete",
+        "research_data": f"{RESEARCH_TEXT} ({index})",
+        "transcript": transcript,
+        "summary": f"{SUMMARY_TEXT} ({index})",
+        "started_at": time.time()
+    }
+
+def fill_sessions(store, count):
+    """Run count analyses' worth of session writes through a store, sampling RSS"""
+    samples = []
+    for index in range(count):
+        session_id = str(uuid.uuid4())
+        session = completed_session(index)
+        if isinstance(store, dict):
+            store[session_id] = session
+        else:
+            store.create(session_id, {"company_name": session["company_name"], "status": "queued"})
+            store.update(session_id, research_data=session["research_data"], status="discussion")
+            store.update(session_id, transcript=session["transcript"], status="summarizing")
+            store.update(session_id, summary=session["summary"], status="complete")
+        if (index + 1) % max(1, count // 5) == 0:
+            gc.collect()
+            samples.append((index + 1, current_rss_mb()))
+    return samples
+
+def benchmark_sessions(args):
+    print(f"Session memory benchmark with {args.count} sessions")
+    # The bounded store runs first so it cannot reuse memory freed by the dict run
+    stores = [
+        ("session store", lambda: InMemorySessionStore(
+            max_entries=args.max_entries,
+            max_bytes=args.max_mb * 1024 * 1024,
+            sweep_interval=0
+        )),
+        ("plain dict", dict)
+    ]
+    for name, make_store in stores:
+        store = make_store()
+        gc.collect()
+        baseline = current_rss_mb()
+        samples = fill_sessions(store, args.count)
+        progress = ", ".join(f"{count}: +{rss - baseline:.1f}MB" for count, rss in samples)
+        print(f"  {name:<14} sessions kept={len(store):<6} RSS growth {progress}")
+        del store
+        gc.collect()
+
+class TimedQueue(list):
+    """Packet queue for a Socket.IO test client that stamps each packet on arrival"""
+
+    def append(self, packet):
+        packet["received_at"] = time.time()
+        super().append(packet)
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def benchmark_throughput(args):
+    """Start analyses through /start_analysis and follow them with Socket.IO clients"""
+    # A pool sized for the run, so every session is accepted
+    app_module.analysis_pool = AnalysisPool(
+        max_workers=args.workers,
+        max_queue=args.sessions,
+        on_queue_change=report_queue_positions
+    )
+    http = app.test_client()
+    clients = {}
+    started_at = {}
+    rejected = 0
+
+    run_start = time.time()
+    for index in range(args.sessions):
+        response = http.post('/start_analysis', data={
+            "company_name": f"Benchmark Company {index}",
+            "force_refresh": "1",
+            "rounds": str(args.rounds),
+            "parallel_roundtable": "1" if args.parallel else "",
+            "stream_responses": "1" if args.stream else ""
+        })
+        if response.status_code != 200:
+            rejected += 1
+            continue
+        session_id = response.get_json()["session_id"]
+        started_at[session_id] = time.time()
+        client = socketio.test_client(app)
+        client.queue = TimedQueue()
+        client.emit('get_session_data', {'session_id': session_id})
+        clients[session_id] = client
+
+    completion_times = {}
+    failed = set()
+    delivery_latencies = []
+    events = 0
+    deadline = run_start + args.timeout
+    while len(completion_times) < len(clients) and time.time() < deadline:
+        time.sleep(0.05)
+        for session_id, client in clients.items():
+            count = len(client.queue)
+            packets = client.queue[:count]
+            del client.queue[:count]
+            for packet in packets:
+                events += 1
+                # The test client unwraps the args of events named 'message'
+                payload = packet['args']
+                if isinstance(payload, list):
+                    payload = payload[0] if payload else None
+                if isinstance(payload, dict) and 'timestamp' in payload:
+                    delivery_latencies.append(packet["received_at"] - payload['timestamp'])
+                if packet['name'] == 'analysis_complete' and session_id not in completion_times:
+                    completion_times[session_id] = packet["received_at"] - started_at[session_id]
+                    if payload.get('status') == 'error':
+                        failed.add(session_id)
+    wall_seconds = time.time() - run_start
+
+    for session_id, client in clients.items():
+        client.disconnect()
+        active_sessions.delete(session_id)
+
+    completed = [seconds for session_id, seconds in completion_times.items() if session_id not in failed]
+    print(
+        f"Throughput benchmark: {args.sessions} sessions, {args.workers} workers, {args.rounds} rounds "
+        f"(LLM_BACKEND={os.environ.get('LLM_BACKEND')}, SEARCH_BACKEND={os.environ.get('SEARCH_BACKEND')})"
+    )
+    print(
+        f"  completed={len(completed)} failed={len(failed)} rejected={rejected} "
+        f"unfinished={len(clients) - len(completion_times)} wall={wall_seconds:.1f}s"
+    )
+    print(f"  analyses/minute={len(completed) / wall_seconds * 60:.1f}")
+    print(f"  completion p50={percentile(completed, 0.5):.2f}s p95={percentile(completed, 0.95):.2f}s")
+    print(
+        f"  events={events} delivery p50={percentile(delivery_latencies, 0.5) * 1000:.2f}ms "
+        f"p95={percentile(delivery_latencies, 0.95) * 1000:.2f}ms"
+    )
+
+def wire_bytes(name, args):
+    """Size of an event as a Socket.IO text frame (42["name", ...args])"""
+    return len(("42" + json.dumps([name] + list(args), separators=(",", ":"))).encode())
+
+def deflated_bytes(compressor, name, args):
+    """Size of the same frame with permessage-deflate (context kept across frames)"""
+    frame = ("42" + json.dumps([name] + list(args), separators=(",", ":"))).encode()
+    # Each message ends with an empty stored block that is not sent
+    return len(compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+
+def measure_analysis_wire(index, args):
+    """Run one analysis followed by a Socket.IO client and count the bytes it receives"""
+    session_id = f"wire-{index}-{uuid.uuid4()}"
+    active_sessions.create(session_id, {
+        "company_name": f"Wire Company {index}",
+        "status": "queued",
+        "research_data": "",
+        "transcript": [],
+        "summary": "",
+        "started_at": time.time()
+    })
+    client = socketio.test_client(app)
+    client.emit('get_session_data', {'session_id': session_id, 'last_seq': 0})
+    client.get_received()
+    options = app_module.analysis_options({
+        "rounds": str(args.rounds),
+        "stream_responses": "1" if args.stream else ""
+    })
+    app_module.run_analysis(session_id, f"Wire Company {index}", options)
+
+    totals = {"events": 0, "bytes": 0, "deflated": 0, "fetched": 0}
+    per_event = {}
+    compressor = zlib.compressobj(wbits=-15)
+    for packet in client.get_received():
+        args_list = packet['args'] if isinstance(packet['args'], list) else [packet['args']]
+        size = wire_bytes(packet['name'], args_list)
+        totals["events"] += 1
+        totals["bytes"] += size
+        totals["deflated"] += deflated_bytes(compressor, packet['name'], args_list)
+        per_event[packet['name']] = per_event.get(packet['name'], 0) + size
+        # The results page fetches referenced texts once
+        for payload in args_list:
+            for key, value in (payload.items() if isinstance(payload, dict) else ()):
+                if key.endswith("_ref"):
+                    totals["fetched"] += len(app.test_client().get(value["url"]).data)
+    client.disconnect()
+    active_sessions.delete(session_id)
+    app_module.event_log.delete(session_id)
+    return totals, per_event
+
+def benchmark_wire(args):
+    """Bytes sent to one client per analysis, full payloads vs the compact wire format"""
+    print(
+        f"Wire benchmark: {args.analyses} analyses per format, {args.rounds} rounds, "
+        f"streaming {'on' if args.stream else 'off'}"
+    )
+    compact_setting = app_module.COMPACT_EVENTS
+    try:
+        for label, compact in (("full", False), ("compact", True)):
+            app_module.COMPACT_EVENTS = compact
+            runs = [measure_analysis_wire(index, args) for index in range(args.analyses)]
+            average = {key: statistics.mean(totals[key] for totals, _ in runs) for key in runs[0][0]}
+            events = {}
+            for _, per_event in runs:
+                for name, size in per_event.items():
+                    events[name] = events.get(name, 0) + size / len(runs)
+            print(
+                f"  {label:<8} events={average['events']:.0f} bytes={average['bytes']:.0f} "
+                f"deflated={average['deflated']:.0f} fetched texts={average['fetched']:.0f}"
+            )
+            print("           " + ", ".join(f"{name}={size:.0f}" for name, size in sorted(events.items())))
+    finally:
+        app_module.COMPACT_EVENTS = compact_setting
+
+def check_wire(args):
+    """Exit with an error if a compact, streamed analysis sends a client more than the byte budget"""
+    args.stream = True
+    compact_setting = app_module.COMPACT_EVENTS
+    app_module.COMPACT_EVENTS = True
+    try:
+        totals, per_event = measure_analysis_wire(0, args)
+    finally:
+        app_module.COMPACT_EVENTS = compact_setting
+    print(
+        f"Wire check: {args.rounds} rounds, events={totals['events']} bytes={totals['bytes']} "
+        f"(budget {args.max_bytes}) deflated={totals['deflated']}"
+    )
+    print("  " + ", ".join(f"{name}={size}" for name, size in sorted(per_event.items())))
+    if totals["bytes"] > args.max_bytes:
+        raise SystemExit(f"Compact payloads are over budget: {totals['bytes']} > {args.max_bytes} bytes")
+
+def main():
+    parser = argparse.ArgumentParser(description="BTModel Web benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    fanout = subparsers.add_parser("fanout", help="Socket.IO fan-out: broadcast vs per-session rooms")
+    fanout.add_argument("--sessions", type=int, default=50)
+    fanout.set_defaults(func=benchmark_fanout)
+
+    sessions = subparsers.add_parser("sessions", help="Memory use of a plain dict vs the bounded session store")
+    sessions.add_argument("--count", type=int, default=10000)
+    sessions.add_argument("--max-entries", type=int, default=1000)
+    sessions.add_argument("--max-mb", type=int, default=200)
+    sessions.set_defaults(func=benchmark_sessions)
+
+    throughput = subparsers.add_parser("throughput", help="End-to-end analyses per minute and event delivery latency")
+    throughput.add_argument("--sessions", type=int, default=20)
+    throughput.add_argument("--workers", type=int, default=4)
+    throughput.add_argument("--rounds", type=int, default=2)
+    throughput.add_argument("--parallel", action="store_true", help="Use the parallel roundtable")
+    throughput.add_argument("--stream", action="store_true", help="Stream tokens as message_delta events")
+    throughput.add_argument("--timeout", type=float, default=600)
+    throughput.set_defaults(func=benchmark_throughput)
+
+    wire = subparsers.add_parser("wire", help="Socket.IO bytes per analysis: full payloads vs compact wire format")
+    wire.add_argument("--analyses", type=int, default=3)
+    wire.add_argument("--rounds", type=int, default=2)
+    wire.add_argument("--stream", action="store_true", help="Stream tokens as message_delta events")
+    wire.set_defaults(func=benchmark_wire)
+
+    wire_check = subparsers.add_parser("wire-check", help="Fail if a compact, streamed analysis exceeds a byte budget")
+    wire_check.add_argument("--rounds", type=int, default=1)
+    wire_check.add_argument("--max-bytes", type=int, default=60000)
+    wire_check.set_defaults(func=check_wire)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+# checkpoint.py
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+# Set up logging
+logger = logging.getLogger('btmodel-web')
+
+# ---------------------------
+# Analysis Checkpoints
+# ---------------------------
+class CheckpointStore:
+    """
+    SQLite record of unfinished analyses: the request that started each one
+    and an append-only log of the steps completed since (research, round
+    plans, transcript turns). The process running an analysis owns its
+    checkpoint and keeps it fresh with heartbeat(); a checkpoint nobody has
+    touched for a while belongs to a process that died, and another process
+    can claim it and resume from the last completed step.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Identifies this process as the owner of the analyses it runs
+        self.owner = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+
+        with self._lock, self._conn as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS analyses ("
+                " session_id TEXT PRIMARY KEY,"
+                " company_name TEXT NOT NULL,"
+                " options TEXT NOT NULL,"
+                " started_at REAL NOT NULL,"
+                " owner TEXT NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS steps ("
+                " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " session_id TEXT NOT NULL,"
+                " kind TEXT NOT NULL,"
+                " payload TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS steps_session ON steps (session_id, seq)")
+
+    def start(self, session_id, company_name, options, started_at):
+        """Record a new analysis, owned by this process"""
+        now = time.time()
+        with self._lock, self._conn as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO analyses (session_id, company_name, options, started_at, owner, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (session_id, company_name, json.dumps(options), started_at, self.owner, now)
+            )
+
+    def append(self, session_id, kind, data):
+        """Record a completed step of an analysis; ignored for analyses that were never started here"""
+        with self._lock, self._conn as conn:
+            conn.execute(
+                "INSERT INTO steps (session_id, kind, payload) "
+                "SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM analyses WHERE session_id = ?)",
+                (session_id, kind, json.dumps(data), session_id)
+            )
+            conn.execute(
+                "UPDATE analyses SET updated_at = ? WHERE session_id = ?", (time.time(), session_id)
+            )
+
+    def steps(self, session_id):
+        """Return the recorded steps of an analysis as (kind, data) pairs, oldest first"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT kind, payload FROM steps WHERE session_id = ? ORDER BY seq", (session_id,)
+            ).fetchall()
+        return [(kind, json.loads(payload)) for kind, payload in rows]
+
+    def finish(self, session_id):
+        """Forget an analysis that has reached a final status"""
+        with self._lock, self._conn as conn:
+            conn.execute("DELETE FROM steps WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM analyses WHERE session_id = ?", (session_id,))
+
+    def heartbeat(self, session_ids):
+        """Mark this process's analyses as still being worked on"""
+        if not session_ids:
+            return
+        now = time.time()
+        with self._lock, self._conn as conn:
+            conn.executemany(
+                "UPDATE analyses SET updated_at = ? WHERE session_id = ? AND owner = ?",
+                [(now, session_id, self.owner) for session_id in session_ids]
+            )
+
+    def claim_stale(self, stale_seconds, max_age=None):
+        """
+        Take over analyses whose checkpoints have not been touched for
+        stale_seconds. Returns a list of dicts with session_id, company_name,
+        options and started_at. Checkpoints older than max_age are dropped.
+        """
+        now = time.time()
+        claimed = []
+        with self._lock, self._conn as conn:
+            if max_age:
+                expired = [row[0] for row in conn.execute(
+                    "SELECT session_id FROM analyses WHERE started_at < ?", (now - max_age,)
+                )]
+                for session_id in expired:
+                    conn.execute("DELETE FROM steps WHERE session_id = ?", (session_id,))
+                    conn.execute("DELETE FROM analyses WHERE session_id = ?", (session_id,))
+
+            rows = conn.execute(
+                "SELECT session_id, company_name, options, started_at, updated_at FROM analyses "
+                "WHERE updated_at < ? ORDER BY started_at",
+                (now - stale_seconds,)
+            ).fetchall()
+            for session_id, company_name, options, started_at, updated_at in rows:
+                # Only one process wins: the row must still be as stale as we saw it
+                cursor = conn.execute(
+                    "UPDATE analyses SET owner = ?, updated_at = ? WHERE session_id = ? AND updated_at = ?",
+                    (self.owner, now, session_id, updated_at)
+                )
+                if cursor.rowcount:
+                    claimed.append({
+                        "session_id": session_id,
+                        "company_name": company_name,
+                        "options": json.loads(options),
+                        "started_at": started_at
+                    })
+        return claimed
@@ -0,0 +1,704 @@
+# discussion.py
+
+import asyncio
+import inspect
+import json
+import logging
+import os
+import time
+
+from agents import clean_quotation_marks
+from llm import achat, run_sync, check_interrupted, AnalysisInterrupted, DeadlineExceeded
+from metrics import Timeline, FACILITATOR_PARSE_FAILURES
+from transcript import Transcript, trim_text, CHARS_PER_TOKEN, DEFAULT_CONTEXT_TOKENS, RESEARCH_CONTEXT_TOKENS
+
+# Set up logging
+logger = logging.getLogger('btmodel-web')
+
+# Defaults for the discussion shape, overridable per request
+DEFAULT_ROUNDS = int(os.environ.get("DISCUSSION_ROUNDS", "2"))
+MAX_ROUNDS = int(os.environ.get("MAX_DISCUSSION_ROUNDS", "6"))
+DEFAULT_ROUND_BUDGET = float(os.environ.get("ROUND_BUDGET_SECONDS", "0"))  # 0 = no budget
+
+# Cheaper model that fixes a planning reply that did not match its schema
+REPAIR_MODEL = os.environ.get("FACILITATOR_REPAIR_MODEL", "gpt-4o-mini")
+
+ORDINALS = {1: "first", 2: "second", 3: "third", 4: "fourth", 5: "fifth", 6: "sixth"}
+
+def ordinal(number):
+    return ORDINALS.get(number, f"number {number}")
+
+# ---------------------------
+# Round Plan
+# ---------------------------
+class RoundPlan:
+    """
+    What the facilitator decided for one round: the speaking order, the
+    question for the first speaker and how the round is announced.
+    """
+
+    def __init__(self, round_number, order, question, announcement, consensus=False):
+        self.round_number = round_number
+        self.order = order
+        self.question = question
+        self.announcement = announcement
+        # Set when the facilitator judges another round would add little
+        self.consensus = consensus
+
+    def to_dict(self):
+        return {
+            "round": self.round_number,
+            "order": self.order,
+            "question": self.question,
+            "announcement": self.announcement,
+            "consensus": self.consensus
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["round"], data["order"], data["question"], data["announcement"], data["consensus"])
+
+# ---------------------------
+# Structured Facilitator Replies
+# ---------------------------
+class PlanFormatError(ValueError):
+    """A facilitator reply that is not JSON matching the requested schema"""
+
+def opening_plan_schema(names):
+    return {
+        "type": "object",
+        "properties": {
+            "chosen_expert": {"type": "string", "enum": names},
+            "question": {"type": "string"},
+            "reasoning": {"type": "string"}
+        },
+        "required": ["chosen_expert", "question", "reasoning"],
+        "additionalProperties": False
+    }
+
+def round_plan_schema(names, check_consensus=False):
+    schema = {
+        "type": "object",
+        "properties": {
+            "lead_expert": {"type": "string", "enum": names},
+            "theme": {"type": "string"},
+            "order": {"type": "array", "items": {"type": "string", "enum": names}}
+        },
+        "required": ["lead_expert", "theme", "order"],
+        "additionalProperties": False
+    }
+    if check_consensus:
+        schema["properties"]["consensus"] = {"type": "boolean"}
+        schema["required"].append("consensus")
+    return schema
+
+JSON_TYPES = {"object": dict, "array": list, "string": str, "boolean": bool}
+
+def validate_json(value, schema, path="reply"):
+    """
+    Check a decoded value against the subset of JSON Schema the planning
+    schemas use (type, properties, required, items, enum). Required strings
+    must also not be blank, which strict API schemas cannot express.
+    Raises PlanFormatError naming the first field that does not match.
+    """
+    expected = schema.get("type")
+    if expected and not isinstance(value, JSON_TYPES[expected]):
+        raise PlanFormatError(f"{path} should be {'an' if expected[0] in 'aeiou' else 'a'} {expected}")
+    if "enum" in schema and value not in schema["enum"]:
+        raise PlanFormatError(f"{path} should be one of: {', '.join(map(str, schema['enum']))}")
+    if expected == "object":
+        for name in schema.get("required", []):
+            if name not in value:
+                raise PlanFormatError(f"{path} is missing {name}")
+            if isinstance(value[name], str) and not value[name].strip():
+                raise PlanFormatError(f"{path}.{name} should not be empty")
+        for name, field_schema in schema.get("properties", {}).items():
+            if name in value:
+                validate_json(value[name], field_schema, f"{path}.{name}")
+    if expected == "array":
+        for index, item in enumerate(value):
+            validate_json(item, schema.get("items", {}), f"{path}[{index}]")
+
+def parse_plan(reply, schema):
+    """Decode a JSON planning reply and validate it, raising PlanFormatError if it does not match"""
+    try:
+        plan = json.loads(reply)
+    except (TypeError, ValueError) as e:
+        raise PlanFormatError(f"reply is not valid JSON ({str(e)})")
+    validate_json(plan, schema)
+    return plan
+
+def json_schema_format(name, schema):
+    """response_format asking the API for output that follows the schema"""
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+# ---------------------------
+# Facilitator Strategies
+# ---------------------------
+class FacilitatorStrategy:
+    """
+    Decides how each round runs. Subclass and override plan_round() and
+    follow_up() to try a different facilitation style. The engine awaits
+    aplan_round() and afollow_up(), which run those on a worker thread
+    unless a subclass overrides them with coroutines of its own.
+    """
+
+    def plan_round(self, discussion, round_number):
+        """Return a RoundPlan for the round"""
+        raise NotImplementedError
+
+    def follow_up(self, discussion, previous_agent, previous_response, next_agent, on_delta=None):
+        """Return the question handing the floor from previous_agent to next_agent"""
+        raise NotImplementedError
+
+    async def aplan_round(self, discussion, round_number):
+        return await asyncio.to_thread(self.plan_round, discussion, round_number)
+
+    async def afollow_up(self, discussion, previous_agent, previous_response, next_agent, on_delta=None):
+        return await asyncio.to_thread(
+            self.follow_up, discussion, previous_agent, previous_response, next_agent, on_delta=on_delta
+        )
+
+class LLMFacilitator(FacilitatorStrategy):
+    """
+    The GPT-4o facilitator: picks who opens each round and writes the
+    follow-up questions. Round plans are requested as JSON following a
+    schema; a reply that does not validate gets one repair attempt with
+    repair_model before the plan falls back to defaults.
+    """
+
+    def __init__(self, model="gpt-4o", check_consensus=False, repair_model=REPAIR_MODEL):
+        self.model = model
+        self.repair_model = repair_model
+        # Ask the planner whether the panel has converged before each later round
+        self.check_consensus = check_consensus
+
+    async def _aask(self, prompt, system="You are a helpful assistant.", phase="planning", model=None,
+                    temperature=0.7, **kwargs):
+        return await achat(
+            model=model or self.model,
+            messages=[
+                {"role": "system", "content": system},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=temperature,
+            agent="Facilitator",
+            phase=phase,
+            **kwargs
+        )
+
+    async def _aask_plan(self, prompt, name, schema):
+        """
+        Ask for a plan as JSON and return it validated, repairing a reply
+        that does not match the schema once. Returns None if that fails too.
+        """
+        response_format = json_schema_format(name, schema)
+        reply = await self._aask(prompt, response_format=response_format)
+        try:
+            return parse_plan(reply, schema)
+        except PlanFormatError as e:
+            error = e
+        logger.warning(f"Facilitator {name} did not match its schema ({str(error)}), asking for a repair")
+
+        repair_prompt = (
+            f"This reply should have been a JSON object matching the schema below, but {error}.\n\n"
+            f"Schema:\n{json.dumps(schema)}\n\n"
+            f"Reply:\n{reply}\n\n"
+            "Return the corrected JSON object only, keeping the reply's content."
+        )
+        try:
+            plan = parse_plan(await self._aask(
+                repair_prompt,
+                system="You correct JSON so that it matches a schema.",
+                phase="planning_repair",
+                model=self.repair_model,
+                temperature=0,
+                max_tokens=400,
+                response_format=response_format
+            ), schema)
+        except AnalysisInterrupted:
+            raise
+        except Exception as e:
+            logger.error(f"Could not repair facilitator {name}: {str(e)}")
+            FACILITATOR_PARSE_FAILURES.inc(plan=name, outcome="fallback")
+            return None
+        FACILITATOR_PARSE_FAILURES.inc(plan=name, outcome="repaired")
+        return plan
+
+    def plan_round(self, discussion, round_number):
+        return run_sync(self.aplan_round(discussion, round_number))
+
+    def follow_up(self, discussion, previous_agent, previous_response, next_agent, on_delta=None):
+        return run_sync(self.afollow_up(discussion, previous_agent, previous_response, next_agent, on_delta=on_delta))
+
+    async def aplan_round(self, discussion, round_number):
+        if round_number == 1:
+            return await self._aplan_opening_round(discussion)
+        return await self._aplan_later_round(discussion, round_number)
+
+    async def _aplan_opening_round(self, discussion):
+        company_name = discussion.company_name
+        names = list(discussion.agents)
+        if len(names) > 1:
+            choices = ", ".join(names[:-1]) + f", or {names[-1]}"
+        else:
+            choices = names[0]
+
+        # First analyze the research to determine which agent should start
+        facilitator_analysis_prompt = f"""
+        You are a discussion facilitator for a business technology analysis roundtable.
+
+        Research about {company_name}:
+
+        {discussion.research_context}
+
+        Based on this research data about {company_name}, analyze the key themes and determine:
+        1. Which expert should begin our discussion (choose from: {choices})
+        2. A natural, conversational opening question that references a key insight from the research
+        3. Explain in 1-2 sentences why you've chosen this expert to begin
+
+        Your opening question should be framed in a conversational way that references something specific from the research, such as:
+        The research shows that {company_name} is aiming to be a market leader in the Nordics. What do you think about this positioning in light of the data?
+
+        Make the question sound natural, as if you're having a real conversation rather than an interview.
+        DO NOT include quotation marks around your question.
+
+        Reply with a JSON object with these fields:
+        chosen_expert: the expert name
+        question: your conversational opening question that references the research - no quotation marks
+        reasoning: 1-2 sentence explanation of your choice
+        """
+
+        default_expert = "Business Strategist" if "Business Strategist" in names else names[0]
+        try:
+            plan = await self._aask_plan(facilitator_analysis_prompt, "opening_plan", opening_plan_schema(names))
+
+            if plan:
+                chosen_expert = plan["chosen_expert"]
+                # Clean any quotation marks that might have been included
+                opening_question = clean_quotation_marks(plan["question"].strip())
+            else:
+                chosen_expert = default_expert
+                opening_question = f"The research shows that {company_name} is positioning itself as a leader in business technology transformation in the Nordics. What do you think about this positioning based on the data we have?"
+
+        except AnalysisInterrupted:
+            raise
+        except Exception as e:
+            logger.error(f"Error in facilitator choice: {str(e)}")
+            chosen_expert = default_expert
+            opening_question = f"The research shows that {company_name} is positioning itself in the market. What are your thoughts on their business strategy based on what we've learned?"
+
+        # Start with the chosen expert, then go through the remaining ones
+        order = [chosen_expert] + [name for name in names if name != chosen_expert]
+        return RoundPlan(
+            1, order, opening_question,
+            f"Let's begin our analysis of {company_name}. {opening_question}"
+        )
+
+    async def _aplan_later_round(self, discussion, round_number):
+        company_name = discussion.company_name
+        names = list(discussion.agents)
+
+        consensus_instruction = ""
+        consensus_format = ""
+        if self.check_consensus:
+            consensus_instruction = (
+                "4. Whether the experts already broadly agree, so that another round would add little\n"
+            )
+            consensus_format = "consensus: true if the experts already broadly agree, otherwise false\n"
+
+        # Generate a focused order and question for the round
+        round_prompt = f"""
+        Based on the {ordinal(round_number - 1)} round of discussion about {company_name}:
+
+        {discussion.transcript.context(DEFAULT_CONTEXT_TOKENS * 2)}
+
+        As a facilitator, determine:
+        1. Which expert should lead the {ordinal(round_number)} round (may be different from round {round_number - 1})
+        2. A specific follow-up theme or question that builds on the {ordinal(round_number - 1)} round
+        3. A suggested order for the remaining experts that creates a natural flow
+        {consensus_instruction}
+        DO NOT use quotation marks in your responses.
+
+        Reply with a JSON object with these fields:
+        lead_expert: the expert name
+        theme: concise theme or question for round {round_number} - no quotation marks
+        order: list of the remaining experts in suggested order
+        {consensus_format}"""
+
+        consensus = False
+        try:
+            plan = await self._aask_plan(
+                round_prompt, "round_plan", round_plan_schema(names, check_consensus=self.check_consensus)
+            )
+
+            if plan:
+                lead_expert = plan["lead_expert"]
+                # Clean any quotation marks
+                theme = clean_quotation_marks(plan["theme"].strip())
+                expert_order = plan["order"]
+                consensus = plan.get("consensus", False)
+            else:
+                lead_expert = names[0]
+                theme = f"Let's focus on implementation challenges and opportunities for {company_name}."
+                expert_order = [name for name in names if name != lead_expert]
+
+            # Ensure the order has all remaining experts, once each
+            expert_order = [name for name in dict.fromkeys(expert_order) if name != lead_expert]
+            for name in names:
+                if name != lead_expert and name not in expert_order:
+                    expert_order.append(name)
+
+        except AnalysisInterrupted:
+            raise
+        except Exception as e:
+            logger.error(f"Error in round {round_number} planning: {str(e)}")
+            # Fallback order
+            lead_expert = "Technology Officer" if "Technology Officer" in names else names[0]
+            theme = f"Let's explore implementation challenges and opportunities for {company_name}."
+            expert_order = [name for name in names if name != lead_expert]
+
+        question = f"{theme} What's your perspective on this?"
+        return RoundPlan(
+            round_number, [lead_expert] + expert_order, question,
+            f"Moving to our {ordinal(round_number)} round of discussion. {question}",
+            consensus=consensus
+        )
+
+    async def afollow_up(self, discussion, previous_agent, previous_response, next_agent, on_delta=None):
+        prompt = f"""
+        You are a skilled facilitator running a business technology roundtable discussion about {discussion.company_name}.
+
+        The {previous_agent} just said:
+
+        "{previous_response}"
+
+        Now you need to ask the {next_agent} a follow-up question that:
+        1. Naturally builds on a specific insight from {previous_agent}'s response
+        2. Is tailored to the {next_agent}'s specific expertise and perspective
+        3. Maintains conversation flow like in a real roundtable discussion
+
+        Structure your question like a natural conversation, for example:
+        - That's an interesting point about [specific insight]. From your perspective as {next_agent}, how would this affect...?
+        - {previous_agent} mentioned [specific insight]. How does this align with what you've seen in terms of...?
+        - Building on what we just heard about [specific insight], what's your take on how this impacts...?
+
+        IMPORTANT: DO NOT use quotation marks in your response.
+        Write ONLY the question you would ask the {next_agent} - nothing else, no preamble, no quotation marks.
+        The ideal length is 1-2 sentences, maximum 30 words.
+        """
+
+        try:
+            follow_up = await self._aask(
+                prompt,
+                system="You are a skilled discussion facilitator.",
+                phase="follow_up",
+                max_tokens=100,  # Keep it concise
+                on_delta=on_delta
+            )
+
+            # Clean any quotation marks that might have been included
+            follow_up = clean_quotation_marks(follow_up)
+
+            # Ensure it ends with a question mark
+            if not follow_up.endswith('?'):
+                follow_up += '?'
+
+            return follow_up
+        except AnalysisInterrupted:
+            raise
+        except Exception as e:
+            logger.error(f"Error generating follow-up question: {str(e)}")
+            # Fallback to a generic follow-up
+            return f"Based on what we just heard, what's your perspective as a {next_agent}?"
+
+# ---------------------------
+# Discussion Engine
+# ---------------------------
+class DiscussionEngine:
+    """
+    Runs a roundtable of any number of rounds between the given agents.
+    Each round is planned by the facilitator strategy, then its turns are
+    scheduled one speaker at a time (or, for the first round in parallel
+    mode, answered all at once). A round stops handing out turns once its
+    latency budget is spent, and the discussion ends early if the
+    facilitator judges the panel has reached consensus or when the
+    analysis deadline passes (see llm.analysis_deadline). A cancelled
+    analysis (see llm.analysis_cancel) raises AnalysisCancelled out of run().
+    arun() is the coroutine behind run(), for callers on the event loop.
+
+    The engine reports progress through callbacks: emit(event, payload) for
+    round_update and message events, stream_to(speaker, to) returning an
+    on_delta callback or None, and pace(seconds) between messages. Under
+    arun(), emit, pace and checkpoint may return awaitables, which are
+    awaited; anything blocking belongs off the loop (see llm.BlockingCalls). Planning
+    and every turn are recorded as steps on the timeline, and passed to
+    checkpoint(kind, data) as "plan" and "turn" records once complete;
+    restore() replays those records so a run can continue after a restart.
+    With state_deltas, message events carry only the conversation_state
+    fields that changed since the previous message, leaving out those the
+    message itself implies (speaker, recipient, last response).
+    """
+
+    # conversation_state fields that clients derive from the message itself
+    DERIVED_STATE = ("current_speaker", "current_speaking_to", "last_response")
+
+    def __init__(self, company_name, research_data, agents, facilitator=None, rounds=DEFAULT_ROUNDS,
+                 parallel_first_round=False, round_budget=DEFAULT_ROUND_BUDGET,
+                 emit=None, stream_to=None, pace=None, timeline=None, checkpoint=None, state_deltas=False):
+        self.company_name = company_name
+        self.research_data = research_data
+        # The research as quoted in prompts, cut to its own budget once per analysis
+        self.research_context = trim_text(research_data, RESEARCH_CONTEXT_TOKENS * CHARS_PER_TOKEN)
+        self.agents = agents
+        self.facilitator = facilitator or LLMFacilitator()
+        self.rounds = rounds
+        self.parallel_first_round = parallel_first_round
+        self.round_budget = round_budget
+        self.transcript = Transcript()
+        self.timeline = timeline or Timeline()
+
+        self._emit = emit or (lambda event, payload: None)
+        self._stream_to = stream_to or (lambda speaker, to=None: None)
+        self._pace = pace or (lambda seconds: None)
+        self._checkpoint = checkpoint or (lambda kind, data: None)
+        self.state_deltas = state_deltas
+        # Round plans made before a restart, by round number
+        self._plans = {}
+
+        # Initialize conversation state tracking
+        self.state = {
+            "current_speaker": None,
+            "current_speaking_to": None,
+            "current_question": None,
+            "last_response": None,
+            "next_speaker": None
+        }
+        # The state as of the last message event, for state deltas
+        self._sent_state = {}
+        self.rounds_completed = 0
+        self.skipped_turns = 0
+        # None, "consensus" or "deadline"
+        self.stop_reason = None
+
+    def restore(self, records):
+        """Replay checkpointed (kind, data) records; run() then continues after the last one"""
+        for kind, data in records:
+            if kind == "plan":
+                plan = RoundPlan.from_dict(data)
+                self._plans[plan.round_number] = plan
+            elif kind == "turn":
+                self.transcript.start_round(data["round"])
+                self.transcript.add_turn(data["speaker"], data["text"], to=data["to"])
+        logger.info(f"Restored {len(self._plans)} round plans and {len(self.transcript.turns)} turns")
+
+    def run(self):
+        return run_sync(self.arun())
+
+    async def arun(self):
+        """Run every round and return the transcript, which may be cut short by the deadline"""
+        try:
+            for round_number in range(1, self.rounds + 1):
+                await self._check_interrupted()
+                plan = self._plans.get(round_number)
+                if plan is None:
+                    with self.timeline.step("planning", f"Round {round_number} planning"):
+                        plan = await self.facilitator.aplan_round(self, round_number)
+                    self._plans[round_number] = plan
+                    await self._call(self._checkpoint, "plan", plan.to_dict())
+                if round_number > 1 and plan.consensus:
+                    logger.info(f"Facilitator judged consensus after round {round_number - 1}, ending the discussion")
+                    self.stop_reason = "consensus"
+                    break
+                # A restored round is finished once the next one has been planned
+                if round_number + 1 not in self._plans:
+                    await self.arun_round(plan)
+                self.rounds_completed = round_number
+        except DeadlineExceeded:
+            logger.warning(f"Analysis deadline reached during round {self.transcript.round_number}, ending the discussion")
+            self.stop_reason = "deadline"
+        return self.transcript
+
+    async def _check_interrupted(self):
+        """Stop between steps if the deadline has passed or the analysis was cancelled"""
+        # Polling may read the session store, so it happens off the loop
+        await asyncio.to_thread(check_interrupted, poll=True)
+
+    async def _call(self, callback, *args):
+        result = callback(*args)
+        if inspect.isawaitable(result):
+            await result
+
+    async def arun_round(self, plan):
+        # Turns already taken in this round before a restart
+        round_turns = [turn for turn in self.transcript.turns if turn.round_number == plan.round_number]
+        answered = {turn.speaker for turn in round_turns if turn.speaker != "Facilitator"}
+
+        self.transcript.start_round(plan.round_number)
+        round_header = self.transcript.round_header(plan.round_number)
+        logger.info(round_header)
+
+        if not round_turns:
+            await self._call(self._emit, 'round_update', {
+                'round': plan.round_number,
+                'message': round_header
+            })
+
+        round_deadline = time.monotonic() + self.round_budget if self.round_budget else None
+
+        # In parallel mode the first-round opinions only depend on the research
+        # and the opening question, so request them from every agent at once
+        first_pass_responses = {}
+        parallel = self.parallel_first_round and plan.round_number == 1
+        if parallel:
+            first_pass_responses = await self._gather_first_pass(
+                plan, [name for name in plan.order if name not in answered]
+            )
+
+        for i, agent_name in enumerate(plan.order):
+            if agent_name in answered:
+                continue
+            await self._check_interrupted()
+            if i > 0 and round_deadline is not None and time.monotonic() > round_deadline:
+                skipped = len(plan.order) - i
+                self.skipped_turns += skipped
+                logger.info(
+                    f"Round {plan.round_number} used its {self.round_budget:g}s budget, "
+                    f"skipping {skipped} remaining speakers"
+                )
+                break
+
+            next_speaker = plan.order[i + 1] if i < len(plan.order) - 1 else None
+            last_turn = self.transcript.turns[-1] if self.transcript.turns else None
+            if last_turn and last_turn.round_number == plan.round_number and last_turn.to == agent_name:
+                # The facilitator already asked this question before a restart
+                if i == 0 or parallel:
+                    question, _ = await self._question_for(plan, i, parallel)
+                else:
+                    question = last_turn.text
+            else:
+                question, facilitator_message = await self._question_for(plan, i, parallel)
+                await self._facilitator_turn(agent_name, question, facilitator_message)
+
+            if parallel:
+                response = first_pass_responses[agent_name]
+            else:
+                with self.timeline.step("turn", f"{agent_name} (round {plan.round_number})"):
+                    response = await self.agents[agent_name].aget_response(
+                        self._agent_input(plan.round_number, agent_name, question),
+                        on_delta=self._stream_to(agent_name)
+                    )
+            await self._agent_turn(agent_name, response, next_speaker)
+
+    async def _question_for(self, plan, index, parallel):
+        """Return (question, facilitator_message) for the speaker at index in the round"""
+        agent_name = plan.order[index]
+        if index == 0:
+            return plan.question, plan.announcement
+        if parallel:
+            # Everyone answered the opening question, so the facilitator just hands over
+            question = f"Same question to you, {agent_name}: {plan.question}"
+            return question, question
+
+        # Otherwise build naturally on the previous speaker's answer
+        previous_agent = plan.order[index - 1]
+        previous_turn = self.transcript.last_turn_by(previous_agent)
+        with self.timeline.step("follow_up", f"Question to {agent_name}"):
+            question = await self.facilitator.afollow_up(
+                self, previous_agent, previous_turn.text if previous_turn else "", agent_name,
+                on_delta=self._stream_to('Facilitator', agent_name)
+            )
+        return question, question
+
+    async def _gather_first_pass(self, plan, names):
+        if not names:
+            return {}
+        first_pass_input = self._agent_input(plan.round_number, None, plan.question)
+        logger.info(f"Requesting {len(names)} first-round opinions in parallel")
+
+        with self.timeline.step("turn", f"Round {plan.round_number} opinions (parallel)"):
+            responses = await asyncio.gather(*(
+                self.agents[agent_name].aget_response(first_pass_input, on_delta=self._stream_to(agent_name))
+                for agent_name in names
+            ))
+        return dict(zip(names, responses))
+
+    def _agent_input(self, round_number, agent_name, question):
+        if round_number == 1:
+            return f"""
+            Research about {self.company_name}:
+
+            {self.research_context}
+
+            Previous discussion (if any):
+            {self.transcript.context()}
+
+            Question: {question}
+            """
+
+        previous_turn = self.transcript.last_turn_by(agent_name)
+        if previous_turn:
+            previous_response = f"Your previous response in round {previous_turn.round_number}:\n{previous_turn.text}"
+        else:
+            previous_response = "You haven't spoken yet in this discussion."
+
+        return f"""
+            Research about {self.company_name}:
+
+            {self.research_context}
+
+            Previous discussion:
+
+            {self.transcript.context()}
+
+            Question: {question}
+
+            {previous_response}
+
+            Please build on the discussion rather than repeating points. Respond directly to the question.
+            """
+
+    async def _facilitator_turn(self, agent_name, question, facilitator_message):
+        facilitator_turn = self.transcript.add_turn("Facilitator", facilitator_message, to=agent_name)
+        await self._call(self._checkpoint, "turn", facilitator_turn.to_dict())
+        logger.info(facilitator_turn.line)
+
+        self.state["current_speaker"] = "Facilitator"
+        self.state["current_speaking_to"] = agent_name
+        self.state["current_question"] = question
+        self.state["next_speaker"] = agent_name
+
+        await self._call(self._emit, 'message', {
+            'speaker': 'Facilitator',
+            'to': agent_name,
+            'message': question,
+            'conversation_state': self._state_payload()
+        })
+        await self._call(self._pace, 1)  # Short delay for UI
+
+    def _state_payload(self):
+        if not self.state_deltas:
+            return dict(self.state)
+        changes = {
+            key: value for key, value in self.state.items()
+            if key not in self.DERIVED_STATE and self._sent_state.get(key) != value
+        }
+        self._sent_state.update(changes)
+        return changes
+
+    async def _agent_turn(self, agent_name, response, next_speaker):
+        agent_turn = self.transcript.add_turn(agent_name, response)
+        await self._call(self._checkpoint, "turn", agent_turn.to_dict())
+        logger.info(f"Generated response for {agent_name}")
+
+        self.state["current_speaker"] = agent_name
+        self.state["current_speaking_to"] = None
+        self.state["last_response"] = response[:100] + "..." if len(response) > 100 else response
+        self.state["next_speaker"] = next_speaker
+
+        await self._call(self._emit, 'message', {
+            'speaker': agent_name,
+            'message': response,
+            'conversation_state': self._state_payload()
+        })
+        await self._call(self._pace, 2)  # Delay to allow reading
@@ -0,0 +1,165 @@
+# event_log.py
+
+import json
+import threading
+from collections import OrderedDict, deque
+
+# ---------------------------
+# Event Log Interface
+# ---------------------------
+class EventLog:
+    """
+    Sequence-numbered log of the events emitted for each session, so a
+    client that reconnects with the last sequence number it saw can be
+    sent only the events it missed. Each session keeps its most recent
+    max_events events; since() reports a gap when older ones are needed.
+    """
+
+    def append(self, session_id, event, payload):
+        """Log an event and return its sequence number (1 for a session's first event)"""
+        raise NotImplementedError
+
+    def since(self, session_id, last_seq):
+        """
+        Return the events after last_seq as {"seq", "event", "payload"} dicts,
+        or None if some of them are no longer in the log.
+        """
+        raise NotImplementedError
+
+    def last_seq(self, session_id):
+        """Sequence number of the session's latest event, 0 if there is none"""
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        raise NotImplementedError
+
+def _missing_events(events, last_seq, current_seq):
+    """True if the events after last_seq are not all in the kept events"""
+    if last_seq > current_seq:
+        # The log was lost (e.g. a restart) and numbering started again
+        return True
+    if last_seq == current_seq:
+        return False
+    return not events or events[0]["seq"] > last_seq + 1
+
+# ---------------------------
+# In-Memory Event Log
+# ---------------------------
+class InMemoryEventLog(EventLog):
+    """
+    Event log kept in process, for the most recently active max_sessions
+    sessions and about max_bytes of events in all. Going over the byte
+    bound drops the least recently active sessions' logs first, then the
+    oldest events of the current one. Sequence numbers are kept until
+    delete(), so a session whose log was dropped keeps counting up and its
+    clients see the gap.
+    """
+
+    def __init__(self, max_sessions=1000, max_events=500, max_bytes=20 * 1024 * 1024):
+        self.max_sessions = max_sessions
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self._logs = OrderedDict()  # session_id -> [deque of (event, size), bytes]
+        self._seqs = {}             # session_id -> last seq
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def append(self, session_id, event, payload):
+        entry = {"seq": 0, "event": event, "payload": payload}
+        size = len(json.dumps(entry, default=str))
+        with self._lock:
+            seq = self._seqs[session_id] = self._seqs.get(session_id, 0) + 1
+            entry["seq"] = seq
+            log = self._logs.setdefault(session_id, [deque(), 0])
+            log[0].append((entry, size))
+            log[1] += size
+            self._total_bytes += size
+            self._logs.move_to_end(session_id)
+
+            while len(log[0]) > self.max_events:
+                self._drop_oldest(log)
+            while len(self._logs) > self.max_sessions:
+                self._evict(next(iter(self._logs)))
+            while self._total_bytes > self.max_bytes and len(self._logs) > 1:
+                self._evict(next(iter(self._logs)))
+            while self._total_bytes > self.max_bytes and len(log[0]) > 1:
+                self._drop_oldest(log)
+            return seq
+
+    def since(self, session_id, last_seq):
+        with self._lock:
+            seq = self._seqs.get(session_id, 0)
+            events = [entry for entry, _ in self._logs.get(session_id, ((), 0))[0]]
+        if _missing_events(events, last_seq, seq):
+            return None
+        return [entry for entry in events if entry["seq"] > last_seq]
+
+    def last_seq(self, session_id):
+        with self._lock:
+            return self._seqs.get(session_id, 0)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._evict(session_id)
+            self._seqs.pop(session_id, None)
+
+    # Helpers below expect the lock to be held
+
+    def _drop_oldest(self, log):
+        _, size = log[0].popleft()
+        log[1] -= size
+        self._total_bytes -= size
+
+    def _evict(self, session_id):
+        """Drop a session's events, keeping its sequence number"""
+        log = self._logs.pop(session_id, None)
+        if log is not None:
+            self._total_bytes -= log[1]
+
+# ---------------------------
+# Redis Event Log
+# ---------------------------
+class RedisEventLog(EventLog):
+    """
+    Event log in Redis next to the sessions of a RedisSessionStore, so a
+    client can reconnect to any app process. Logs expire with the session TTL.
+    """
+
+    def __init__(self, client, ttl_seconds=6 * 3600, prefix="btmodel", max_events=500):
+        self.client = client
+        self.ttl_seconds = int(ttl_seconds)
+        self.prefix = prefix
+        self.max_events = max_events
+
+    def _keys(self, session_id):
+        return f"{self.prefix}:events:{session_id}", f"{self.prefix}:event-seq:{session_id}"
+
+    def append(self, session_id, event, payload):
+        events_key, seq_key = self._keys(session_id)
+        seq = self.client.incr(seq_key)
+        entry = json.dumps({"seq": seq, "event": event, "payload": payload}, default=str)
+        pipe = self.client.pipeline()
+        pipe.rpush(events_key, entry)
+        pipe.ltrim(events_key, -self.max_events, -1)
+        pipe.expire(events_key, self.ttl_seconds)
+        pipe.expire(seq_key, self.ttl_seconds)
+        pipe.execute()
+        return seq
+
+    def since(self, session_id, last_seq):
+        events_key, seq_key = self._keys(session_id)
+        pipe = self.client.pipeline()
+        pipe.lrange(events_key, 0, -1)
+        pipe.get(seq_key)
+        raw, seq = pipe.execute()
+        # Appends from different processes can land slightly out of order
+        events = sorted((json.loads(entry) for entry in raw), key=lambda entry: entry["seq"])
+        if _missing_events(events, last_seq, int(seq or 0)):
+            return None
+        return [entry for entry in events if entry["seq"] > last_seq]
+
+    def last_seq(self, session_id):
+        return int(self.client.get(self._keys(session_id)[1]) or 0)
+
+    def delete(self, session_id):
+        self.client.delete(*self._keys(session_id))
@@ -0,0 +1,193 @@
+# fake_backend.py
+
+"""
+Deterministic offline stand-ins for the OpenAI chat completions API and the
+web search, for benchmarks and development without API keys or network.
+Enable with LLM_BACKEND=fake and SEARCH_BACKEND=fake.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import httpx
+import openai
+
+# Set up logging
+logger = logging.getLogger('btmodel-web')
+
+FAKE_URL = "https://fake-llm.invalid/v1/chat/completions"
+
+def _words(rng, count):
+    vocabulary = (
+        "market platform customers growth strategy product data cloud platform teams "
+        "revenue partners roadmap adoption integration governance automation value "
+        "pricing segment investment risk operations innovation experience service"
+    ).split()
+    return " ".join(rng.choice(vocabulary) for _ in range(count))
+
+# ---------------------------
+# Fake Chat Completions
+# ---------------------------
+class FakeChatCompletions:
+    """
+    Mimics client.chat.completions.create(). Every request sleeps for a
+    lognormal time to first token plus completion_tokens / tokens_per_second,
+    may fail with the configured error rate, and answers the facilitator's
+    planning requests with JSON following their schema (or, at
+    format_error_rate, with malformed output). Answers and timings are
+    derived from the prompt and seed, so runs are repeatable.
+    """
+
+    def __init__(self, latency=0.5, latency_sigma=0.3, tokens_per_second=50.0, completion_tokens=150,
+                 error_rate=0.0, error_status=500, format_error_rate=0.0, seed=0, max_prompts=10000):
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.format_error_rate = format_error_rate
+        self.seed = seed
+        # How often each recent prompt has been seen, so a retried request
+        # gets a fresh draw; only the max_prompts most recent are kept
+        self.max_prompts = max_prompts
+        self._attempts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _rng(self, messages):
+        prompt_hash = hashlib.sha256(f"{self.seed}:{messages!r}".encode()).hexdigest()
+        with self._lock:
+            attempt = self._attempts.get(prompt_hash, 0)
+            self._attempts[prompt_hash] = attempt + 1
+            self._attempts.move_to_end(prompt_hash)
+            while len(self._attempts) > self.max_prompts:
+                self._attempts.popitem(last=False)
+        return random.Random(f"{prompt_hash}:{attempt}")
+
+    def _plan_reply(self, response_format, rng):
+        spec = response_format["json_schema"]
+        properties = spec["schema"]["properties"]
+        if rng.random() < self.format_error_rate:
+            # Formatting drift: labelled lines instead of JSON
+            return "\n".join(f"{name.upper()}: {_words(rng, 3)}" for name in properties)
+
+        experts = list(next(field["enum"] for field in properties.values() if "enum" in field))
+        if spec["name"] == "opening_plan":
+            plan = {
+                "chosen_expert": rng.choice(experts),
+                "question": f"The research highlights {_words(rng, 6)}. How do you read that?",
+                "reasoning": f"Their view sets up the {_words(rng, 3)} discussion."
+            }
+        else:
+            rng.shuffle(experts)
+            plan = {
+                "lead_expert": experts[0],
+                "theme": f"Turning {_words(rng, 4)} into results",
+                "order": experts[1:]
+            }
+            if "consensus" in properties:
+                plan["consensus"] = rng.random() < 0.3
+        return json.dumps(plan)
+
+    def _reply(self, messages, rng, max_tokens, response_format=None):
+        prompt = messages[-1]["content"]
+        if response_format and response_format.get("type") == "json_schema":
+            return self._plan_reply(response_format, rng)
+
+        if "follow-up question" in prompt:
+            return f"Building on that point about {_words(rng, 4)}, how would you approach {_words(rng, 3)}?"
+
+        count = min(max_tokens or self.completion_tokens, self.completion_tokens)
+        sentences = []
+        while count > 0:
+            length = min(count, rng.randint(8, 20))
+            sentences.append(_words(rng, length).capitalize() + ".")
+            count -= length
+        return " ".join(sentences)
+
+    def _error(self):
+        request = httpx.Request("POST", FAKE_URL)
+        if self.error_status == 429:
+            response = httpx.Response(429, request=request, headers={"retry-after": "1"})
+            return openai.RateLimitError("Fake rate limit", response=response, body=None)
+        response = httpx.Response(self.error_status, request=request)
+        return openai.InternalServerError("Fake server error", response=response, body=None)
+
+    async def create(self, model, messages, stream=False, max_tokens=None, **kwargs):
+        rng = self._rng(messages)
+        content = self._reply(messages, rng, max_tokens, kwargs.get("response_format"))
+        words = content.split(" ")
+        prompt_tokens = sum(len(message["content"]) for message in messages) // 4
+        usage = SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=len(words),
+            total_tokens=prompt_tokens + len(words)
+        )
+
+        first_token = rng.lognormvariate(math.log(self.latency), self.latency_sigma) if self.latency > 0 else 0
+        per_token = 1 / self.tokens_per_second if self.tokens_per_second > 0 else 0
+        await asyncio.sleep(first_token)
+        if rng.random() < self.error_rate:
+            raise self._error()
+
+        if not stream:
+            await asyncio.sleep(per_token * len(words))
+            message = SimpleNamespace(role="assistant", content=content)
+            return SimpleNamespace(
+                model=model,
+                choices=[SimpleNamespace(index=0, message=message, finish_reason="stop")],
+                usage=usage
+            )
+
+        async def chunks():
+            for index, word in enumerate(words):
+                delta = SimpleNamespace(content=word if index == 0 else " " + word)
+                yield SimpleNamespace(choices=[SimpleNamespace(index=0, delta=delta)], usage=None)
+                await asyncio.sleep(per_token)
+            if (kwargs.get("stream_options") or {}).get("include_usage"):
+                yield SimpleNamespace(choices=[], usage=usage)
+        return chunks()
+
+class FakeAsyncOpenAI:
+    """Drop-in for the parts of AsyncOpenAI the app uses (client.chat.completions.create)"""
+
+    def __init__(self, **kwargs):
+        self.chat = SimpleNamespace(completions=FakeChatCompletions(**kwargs))
+
+    @classmethod
+    def from_env(cls):
+        client = cls(
+            latency=float(os.environ.get("FAKE_LLM_LATENCY", "0.5")),
+            latency_sigma=float(os.environ.get("FAKE_LLM_LATENCY_SIGMA", "0.3")),
+            tokens_per_second=float(os.environ.get("FAKE_LLM_TOKENS_PER_SECOND", "50")),
+            completion_tokens=int(os.environ.get("FAKE_LLM_COMPLETION_TOKENS", "150")),
+            error_rate=float(os.environ.get("FAKE_LLM_ERROR_RATE", "0")),
+            error_status=int(os.environ.get("FAKE_LLM_ERROR_STATUS", "500")),
+            format_error_rate=float(os.environ.get("FAKE_LLM_FORMAT_ERROR_RATE", "0")),
+            seed=int(os.environ.get("FAKE_LLM_SEED", "0"))
+        )
+        logger.info("Using the fake offline LLM backend")
+        return client
+
+# ---------------------------
+# Fake Web Search
+# ---------------------------
+FAKE_SEARCH_LATENCY = float(os.environ.get("FAKE_SEARCH_LATENCY", "0.3"))
+
+def fake_search_results(query):
+    """Return canned search results for query after a short, fixed delay"""
+    time.sleep(FAKE_SEARCH_LATENCY)
+    rng = random.Random(query)
+    return [
+        {"title": f"{query.title()} - result {index + 1}", "snippet": _words(rng, 40).capitalize() + "."}
+        for index in range(5)
+    ]
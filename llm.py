@@ -0,0 +1,416 @@
+# llm.py
+
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import httpcore
+import httpx
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+
+from metrics import record_llm_call
+from scheduler import scheduler, estimate_tokens
+
+# Set up logging
+logger = logging.getLogger('btmodel-web')
+
+# Load environment variables from .env
+load_dotenv()
+
+DEFAULT_MODEL = "gpt-4o"
+
+# Connection pool settings for the shared OpenAI client
+POOL_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", "100"))
+POOL_MAX_KEEPALIVE = int(os.environ.get("OPENAI_MAX_KEEPALIVE", "20"))
+POOL_KEEPALIVE_EXPIRY = float(os.environ.get("OPENAI_KEEPALIVE_EXPIRY", "30"))
+REQUEST_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", "60"))
+CONNECT_TIMEOUT = float(os.environ.get("OPENAI_CONNECT_TIMEOUT", "10"))
+
+# Upper bound for one LLM call, including retries and rate limit waits (0 = none)
+CALL_TIMEOUT = float(os.environ.get("LLM_CALL_TIMEOUT", "120"))
+
+# Worker threads of the shared loop's default executor, which runs the
+# blocking calls of analyses (session store writes, emits, checkpoints).
+# Web searches have threads of their own (SEARCH_THREADS in tools.py).
+# Defaults to the size of Python's own default executor.
+BLOCKING_CALL_THREADS = int(os.environ.get("BLOCKING_CALL_THREADS") or min(32, (os.cpu_count() or 1) + 4))
+
+# "fake" swaps in the offline stand-in from fake_backend.py
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "openai")
+
+# Monotonic time by which the current analysis must finish; set by
+# run_analysis and inherited by every task and thread the analysis starts
+analysis_deadline = contextvars.ContextVar("analysis_deadline", default=None)
+
+# CancellationToken of the current analysis, propagated the same way
+analysis_cancel = contextvars.ContextVar("analysis_cancel", default=None)
+
+class AnalysisInterrupted(Exception):
+    """Base for the reasons an analysis stops before it is finished"""
+    pass
+
+class DeadlineExceeded(AnalysisInterrupted):
+    """Raised when the current analysis has run out of time"""
+    pass
+
+class AnalysisCancelled(AnalysisInterrupted):
+    """Raised when the current analysis has been cancelled"""
+    pass
+
+def time_remaining():
+    """Seconds left before the current analysis deadline, or None if there is none"""
+    deadline = analysis_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+def check_interrupted(poll=False):
+    """
+    Raise AnalysisCancelled or DeadlineExceeded if the current analysis should
+    stop. With poll, the token's external check (e.g. the session store) is
+    consulted too; that may block, so it is only done between steps.
+    """
+    token = analysis_cancel.get()
+    if token is not None and token.is_cancelled(poll=poll):
+        raise AnalysisCancelled("Analysis cancelled")
+    remaining = time_remaining()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded("Analysis deadline reached")
+
+# ---------------------------
+# Cancellation Token
+# ---------------------------
+class CancellationToken:
+    """
+    Cancels one analysis. The pipeline checks it between steps, and LLM
+    calls in flight on the shared event loop are cancelled the moment it is
+    tripped, so the analysis stops without waiting for them to finish.
+    check() is an optional extra source, such as a flag another process
+    wrote to the session store.
+    """
+
+    def __init__(self, check=None):
+        self.check = check
+        self._event = threading.Event()
+        self._tasks = set()
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            self._event.set()
+            tasks = list(self._tasks)
+        for task in tasks:
+            task.get_loop().call_soon_threadsafe(task.cancel)
+
+    def is_cancelled(self, poll=False):
+        if poll and not self._event.is_set() and self.check:
+            try:
+                if self.check():
+                    self.cancel()
+            except Exception as e:
+                logger.error(f"Error checking for cancellation: {str(e)}")
+        return self._event.is_set()
+
+    def track(self, task):
+        """Cancel task along with the analysis; returns False if that already happened"""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self._tasks.add(task)
+            return True
+
+    def untrack(self, task):
+        with self._lock:
+            self._tasks.discard(task)
+
+# ---------------------------
+# Pooled OpenAI Client
+# ---------------------------
+class CountingTransport(httpx.AsyncHTTPTransport):
+    """
+    An httpx transport that counts whether each request could reuse an open
+    keep-alive connection (hit) or had to open a new one (miss).
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.hits = 0
+        self.misses = 0
+        # Requests that counted a hit but have not yet taken their connection
+        self._pending_reuse = 0
+        self._counter_lock = threading.Lock()
+
+    def _reusable_connections(self, request):
+        pool = getattr(self, "_pool", None)
+        if pool is None:
+            return 0
+        scheme = request.url.raw_scheme
+        port = request.url.port or (443 if scheme == b"https" else 80)
+        origin = httpcore.Origin(scheme=scheme, host=request.url.raw_host, port=port)
+        return sum(
+            1 for connection in pool.connections
+            if connection.is_available() and connection.can_handle_request(origin)
+        )
+
+    async def handle_async_request(self, request):
+        with self._counter_lock:
+            reused = self._reusable_connections(request) > self._pending_reuse
+            if reused:
+                self.hits += 1
+                self._pending_reuse += 1
+            else:
+                self.misses += 1
+        try:
+            return await super().handle_async_request(request)
+        finally:
+            if reused:
+                with self._counter_lock:
+                    self._pending_reuse -= 1
+
+    def stats(self):
+        pool = getattr(self, "_pool", None)
+        connections = pool.connections if pool is not None else []
+        with self._counter_lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "open_connections": len(connections),
+                "idle_connections": sum(1 for connection in connections if connection.is_idle())
+            }
+
+_client = None
+_transport = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """
+    Return the process-wide AsyncOpenAI client, creating it on first use.
+    Every agent and the facilitator share its connection pool.
+    """
+    global _client, _transport
+    with _client_lock:
+        if _client is None and LLM_BACKEND == "fake":
+            from fake_backend import FakeAsyncOpenAI
+            _client = FakeAsyncOpenAI.from_env()
+        elif _client is None:
+            _transport = CountingTransport(
+                limits=httpx.Limits(
+                    max_connections=POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=POOL_MAX_KEEPALIVE,
+                    keepalive_expiry=POOL_KEEPALIVE_EXPIRY
+                )
+            )
+            _client = AsyncOpenAI(
+                api_key=os.environ.get("OPENAI_API_KEY"),
+                # Retries are handled by the shared scheduler, which also
+                # keeps every worker within the rate limit budget
+                max_retries=0,
+                http_client=httpx.AsyncClient(
+                    transport=_transport,
+                    timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT)
+                )
+            )
+            logger.info(
+                f"Created shared OpenAI client (max_connections={POOL_MAX_CONNECTIONS}, "
+                f"max_keepalive={POOL_MAX_KEEPALIVE})"
+            )
+        return _client
+
+def pool_stats():
+    """Return connection pool counters for the shared client"""
+    with _client_lock:
+        transport = _transport
+    stats = {
+        "max_connections": POOL_MAX_CONNECTIONS,
+        "max_keepalive": POOL_MAX_KEEPALIVE,
+        "hits": 0,
+        "misses": 0,
+        "open_connections": 0,
+        "idle_connections": 0
+    }
+    if transport is not None:
+        stats.update(transport.stats())
+    return stats
+
+# ---------------------------
+# Shared Event Loop
+# ---------------------------
+_loop = None
+_loop_lock = threading.Lock()
+
+def get_event_loop():
+    """Return the process-wide event loop, starting its thread on first use"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop.set_default_executor(
+                ThreadPoolExecutor(max_workers=BLOCKING_CALL_THREADS, thread_name_prefix="blocking-call")
+            )
+            loop_thread = threading.Thread(target=_loop.run_forever, name="llm-event-loop")
+            loop_thread.daemon = True
+            loop_thread.start()
+            logger.info("Started shared LLM event loop")
+        return _loop
+
+def run_sync(coro):
+    """
+    Run a coroutine on the shared event loop and block the calling thread
+    until it finishes. This is what the synchronous agent API wraps.
+    """
+    loop = get_event_loop()
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    if running_loop is loop:
+        coro.close()
+        raise RuntimeError("run_sync() cannot be called from the shared event loop; await the coroutine instead")
+
+    future = asyncio.run_coroutine_threadsafe(coro, loop)
+    return future.result()
+
+class BlockingCalls:
+    """
+    Runs the blocking calls of one analysis (session store writes, emits,
+    checkpoints) on the event loop's default executor, one at a time and in
+    the order they were made, so the coroutine itself never blocks the loop.
+    Only use it from the event loop.
+    """
+
+    def __init__(self):
+        self._last = None
+
+    def call(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) and return a future for its result"""
+        previous = self._last
+
+        async def run():
+            if previous is not None:
+                # Wait for the previous call, whatever its outcome
+                await asyncio.wait([previous])
+            return await asyncio.to_thread(fn, *args, **kwargs)
+
+        self._last = asyncio.ensure_future(run())
+        return self._last
+
+    def post(self, fn, *args, **kwargs):
+        """Like call(), for calls nobody waits on; their errors are logged"""
+        self.call(fn, *args, **kwargs).add_done_callback(self._log_error)
+
+    async def join(self):
+        """Wait until every queued call has finished"""
+        if self._last is not None:
+            await asyncio.wait([self._last])
+
+    @staticmethod
+    def _log_error(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Error in background call: {str(future.exception())}")
+
+# ---------------------------
+# Chat Completions
+# ---------------------------
+async def achat(messages, model=DEFAULT_MODEL, temperature=0.7, max_tokens=None, on_delta=None,
+                agent=None, phase=None, response_format=None):
+    """
+    Request a chat completion and return the stripped message text.
+    If on_delta is given, the completion is streamed and on_delta is called
+    with each text fragment as it arrives. response_format is passed to the
+    API as is, e.g. to ask for JSON following a schema. Requests wait for
+    the shared rate limit budget and transient errors are retried by the
+    scheduler. Latency and token usage are recorded in the metrics registry
+    under the given agent and phase.
+    The whole call is limited to LLM_CALL_TIMEOUT and to the time left before
+    the analysis deadline; running out of the latter raises DeadlineExceeded.
+    Cancelling the analysis aborts the call with AnalysisCancelled.
+    """
+    check_interrupted()
+    timeout = CALL_TIMEOUT or None
+    remaining = time_remaining()
+    if remaining is not None:
+        timeout = min(timeout, remaining) if timeout else remaining
+    token = analysis_cancel.get()
+
+    request_args = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature
+    }
+    if max_tokens is not None:
+        request_args["max_tokens"] = max_tokens
+    if response_format is not None:
+        request_args["response_format"] = response_format
+
+    start = time.perf_counter()
+    usage = None
+    first_token_seconds = None
+    error = None
+
+    async def request():
+        nonlocal usage, first_token_seconds
+        if on_delta is None:
+            response = await get_client().chat.completions.create(**request_args)
+            usage = response.usage
+            return response.choices[0].message.content.strip()
+
+        # Ask for a final usage chunk so streamed calls are counted too
+        stream = await get_client().chat.completions.create(
+            stream=True, stream_options={"include_usage": True}, **request_args
+        )
+        parts = []
+        async for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if first_token_seconds is None:
+                    first_token_seconds = time.perf_counter() - start
+                parts.append(delta)
+                on_delta(delta)
+        return "".join(parts).strip()
+
+    estimated_tokens = estimate_tokens(messages, max_tokens)
+    # The call is a task of its own, so cancelling the analysis aborts just
+    # the call and not the coroutine that awaits it
+    # (a stream that already passed tokens on cannot be retried cleanly)
+    task = asyncio.ensure_future(asyncio.wait_for(
+        scheduler.call(request, estimated_tokens, can_retry=lambda: first_token_seconds is None),
+        timeout
+    ))
+    if token is not None and not token.track(task):
+        task.cancel()
+        raise AnalysisCancelled("Analysis cancelled")
+    try:
+        return await task
+    except asyncio.TimeoutError:
+        if remaining is not None and timeout >= remaining:
+            error = DeadlineExceeded("Analysis deadline reached")
+        else:
+            error = TimeoutError(f"LLM call timed out after {timeout:g}s")
+        raise error
+    except asyncio.CancelledError:
+        if token is None or not token.is_cancelled():
+            raise
+        error = AnalysisCancelled("Analysis cancelled")
+        raise error
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        if token is not None:
+            token.untrack(task)
+        scheduler.settle(estimated_tokens, getattr(usage, "total_tokens", None))
+        record_llm_call(
+            model, agent or "unknown", phase or "unknown", time.perf_counter() - start,
+            prompt_tokens=getattr(usage, "prompt_tokens", None),
+            completion_tokens=getattr(usage, "completion_tokens", None),
+            first_token_seconds=first_token_seconds,
+            error=error
+        )
@@ -0,0 +1,229 @@
+# metrics.py
+
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Set up logging
+logger = logging.getLogger('btmodel-web')
+
+# Session the current analysis belongs to; copied into event loop tasks and
+# worker threads so LLM calls can be attributed without passing it around
+current_session = contextvars.ContextVar("current_session", default=None)
+
+# Latency buckets in seconds, from a quick follow-up question to a long summary
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120, 300)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# ---------------------------
+# Metric Types
+# ---------------------------
+class Counter:
+    """A monotonically increasing value per label set"""
+
+    type_name = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple((name, labels.get(name) or "") for name in self.labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in sorted(self._values.items())]
+
+class Histogram(Counter):
+    """Observations counted into cumulative buckets, plus their sum and count"""
+
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    samples.append((f"{self.name}_bucket", key + (("le", _format_value(bound)),), count))
+                samples.append((f"{self.name}_sum", key, total))
+                samples.append((f"{self.name}_count", key, counts[-1]))
+        return samples
+
+# ---------------------------
+# Metrics Registry
+# ---------------------------
+class MetricsRegistry:
+    """In-process metrics, rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self._register(Counter(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+registry = MetricsRegistry()
+
+LLM_REQUESTS = registry.counter(
+    "btmodel_llm_requests_total", "Chat completion requests by outcome",
+    ("model", "agent", "phase", "outcome")
+)
+LLM_LATENCY = registry.histogram(
+    "btmodel_llm_request_seconds", "Chat completion latency",
+    ("model", "agent", "phase")
+)
+LLM_FIRST_TOKEN = registry.histogram(
+    "btmodel_llm_first_token_seconds", "Time to the first streamed token",
+    ("model", "agent", "phase")
+)
+LLM_TOKENS = registry.counter(
+    "btmodel_llm_tokens_total", "Tokens used by chat completions",
+    ("model", "agent", "phase", "kind")
+)
+LLM_RETRIES = registry.counter(
+    "btmodel_llm_retries_total", "Chat completion requests retried after a transient error",
+    ("reason",)
+)
+LLM_THROTTLE = registry.histogram(
+    "btmodel_llm_throttle_seconds", "Time requests waited for the shared rate limit budget"
+)
+FACILITATOR_PARSE_FAILURES = registry.counter(
+    "btmodel_facilitator_parse_failures_total",
+    "Facilitator planning replies that did not match their schema, by whether a repair saved them",
+    ("plan", "outcome")
+)
+PHASE_LATENCY = registry.histogram(
+    "btmodel_analysis_phase_seconds", "Time spent in each phase of an analysis",
+    ("phase",)
+)
+
+# Recent calls with their session id, which is too high-cardinality for a label
+recent_calls = deque(maxlen=500)
+
+def record_llm_call(model, agent, phase, seconds, prompt_tokens=None, completion_tokens=None,
+                    first_token_seconds=None, error=None):
+    """Record one chat completion request"""
+    labels = {"model": model, "agent": agent, "phase": phase}
+    LLM_REQUESTS.inc(outcome=type(error).__name__ if error else "ok", **labels)
+    LLM_LATENCY.observe(seconds, **labels)
+    if first_token_seconds is not None:
+        LLM_FIRST_TOKEN.observe(first_token_seconds, **labels)
+    if prompt_tokens:
+        LLM_TOKENS.inc(prompt_tokens, kind="prompt", **labels)
+    if completion_tokens:
+        LLM_TOKENS.inc(completion_tokens, kind="completion", **labels)
+
+    recent_calls.append({
+        "session_id": current_session.get(),
+        "model": model,
+        "agent": agent,
+        "phase": phase,
+        "seconds": round(seconds, 3),
+        "first_token_seconds": round(first_token_seconds, 3) if first_token_seconds is not None else None,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "error": str(error) if error else None,
+        "finished_at": time.time()
+    })
+
+# ---------------------------
+# Session Timeline
+# ---------------------------
+class Timeline:
+    """
+    Start and end times of the steps of one analysis (research, planning,
+    each turn, summary), kept with the session for the results waterfall.
+    on_change is called with the step list whenever a step starts or ends.
+    """
+
+    def __init__(self, on_change=None):
+        self.steps = []
+        self.on_change = on_change
+        self._lock = threading.Lock()
+
+    def add(self, phase, label, start, end):
+        """Record a step that has already finished"""
+        with self._lock:
+            self.steps.append({"phase": phase, "label": label, "start": start, "end": end})
+        self._changed()
+
+    @contextmanager
+    def step(self, phase, label=None):
+        """Record the block as a step; it shows as running until the block exits"""
+        entry = {"phase": phase, "label": label or phase, "start": time.time(), "end": None}
+        with self._lock:
+            self.steps.append(entry)
+        self._changed()
+        try:
+            yield entry
+        finally:
+            with self._lock:
+                entry["end"] = time.time()
+            self._changed()
+
+    def to_list(self):
+        with self._lock:
+            return [dict(entry) for entry in self.steps]
+
+    def _changed(self):
+        if self.on_change:
+            try:
+                self.on_change(self.to_list())
+            except Exception as e:
+                logger.error(f"Error saving analysis timeline: {str(e)}")
@@ -0,0 +1,98 @@
+# presence.py
+
+import logging
+import threading
+import time
+
+# Set up logging
+logger = logging.getLogger('btmodel-web')
+
+# ---------------------------
+# Session Presence
+# ---------------------------
+class SessionPresence:
+    """
+    Tracks which Socket.IO clients are watching which analysis session and
+    calls on_abandoned(session_id) once every client that watched a session
+    has been gone for grace_seconds. Status polls count as watching too, so
+    a polling client keeps its session alive as long as it keeps polling.
+    Sessions nobody has ever watched are left alone. The grace period covers
+    page navigation and short reconnects; a grace of 0 disables the
+    callback. Membership is only known to the process the clients are
+    connected to, so the app disables the callback when several processes
+    share a message queue.
+    """
+
+    def __init__(self, grace_seconds, on_abandoned):
+        self.grace_seconds = grace_seconds
+        self.on_abandoned = on_abandoned
+        self._members = {}   # session_id -> set of sids
+        self._sessions = {}  # sid -> set of session_ids
+        self._timers = {}    # session_id -> threading.Timer
+        self._polled = {}    # session_id -> time of the latest status poll
+        self._lock = threading.Lock()
+
+    def join(self, sid, session_id):
+        with self._lock:
+            self._members.setdefault(session_id, set()).add(sid)
+            self._sessions.setdefault(sid, set()).add(session_id)
+            timer = self._timers.pop(session_id, None)
+        if timer:
+            timer.cancel()
+
+    def poll(self, session_id):
+        """Count a status poll as watching; the grace period runs from the latest poll"""
+        with self._lock:
+            self._polled[session_id] = time.monotonic()
+            if not self._members.get(session_id):
+                self._start_timer(session_id)
+
+    def leave(self, sid):
+        """Forget a disconnected client, starting the grace period of sessions it was the last watcher of"""
+        with self._lock:
+            for session_id in self._sessions.pop(sid, set()):
+                members = self._members.get(session_id)
+                if members is None:
+                    continue
+                members.discard(sid)
+                if not members:
+                    del self._members[session_id]
+                    self._start_timer(session_id)
+
+    def forget(self, session_id):
+        """Stop tracking a session whose analysis has finished"""
+        with self._lock:
+            for sid in self._members.pop(session_id, set()):
+                self._sessions.get(sid, set()).discard(session_id)
+            self._polled.pop(session_id, None)
+            timer = self._timers.pop(session_id, None)
+        if timer:
+            timer.cancel()
+
+    def _start_timer(self, session_id, delay=None):
+        # Called with the lock held
+        if not self.grace_seconds or session_id in self._timers:
+            return
+        timer = threading.Timer(delay or self.grace_seconds, self._expire, [session_id])
+        timer.daemon = True
+        self._timers[session_id] = timer
+        timer.start()
+
+    def _expire(self, session_id):
+        with self._lock:
+            if self._timers.get(session_id) is not threading.current_thread():
+                return
+            del self._timers[session_id]
+            if self._members.get(session_id):
+                return
+            # Polled since the timer started: wait out the rest of the grace period
+            since_poll = time.monotonic() - self._polled.get(session_id, float("-inf"))
+            if since_poll < self.grace_seconds:
+                self._start_timer(session_id, self.grace_seconds - since_poll)
+                return
+            self._polled.pop(session_id, None)
+        logger.info(f"No clients watching session {session_id} for {self.grace_seconds:g}s")
+        try:
+            self.on_abandoned(session_id)
+        except Exception as e:
+            logger.error(f"Error handling abandoned session {session_id}: {str(e)}")
@@ -0,0 +1,88 @@
+# result_cache.py
+
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+# Set up logging
+logger = logging.getLogger('btmodel-web')
+
+def normalize_company_name(company_name):
+    """Normalize a company name so 'Acme Inc.' and ' acme inc ' share a cache entry"""
+    name = re.sub(r"[^\w\s&-]", "", company_name.lower())
+    return re.sub(r"\s+", " ", name).strip()
+
+# ---------------------------
+# Completed Analysis Cache
+# ---------------------------
+class ResultCache:
+    """
+    SQLite-backed cache of completed analyses keyed by normalized company
+    name plus the prompt/model version, with TTL expiry and LRU eviction.
+    """
+
+    def __init__(self, path, version, ttl_seconds=7 * 24 * 3600, max_entries=500):
+        self.path = path
+        self.version = version
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+
+        with self._lock, self._conn as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " cache_key TEXT PRIMARY KEY,"
+                " company_name TEXT NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+
+    def key(self, company_name, variant=None):
+        """Variant distinguishes analyses run with non-default settings"""
+        key = f"{self.version}:{normalize_company_name(company_name)}"
+        return f"{key}:{variant}" if variant else key
+
+    def get(self, company_name, variant=None):
+        """Return the cached result dict for a company, or None if missing or expired"""
+        cache_key = self.key(company_name, variant)
+        now = time.time()
+        with self._lock, self._conn as conn:
+            row = conn.execute(
+                "SELECT payload, created_at FROM results WHERE cache_key = ?", (cache_key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            payload, created_at = row
+            if now - created_at > self.ttl_seconds:
+                conn.execute("DELETE FROM results WHERE cache_key = ?", (cache_key,))
+                return None
+
+            conn.execute("UPDATE results SET last_access = ? WHERE cache_key = ?", (now, cache_key))
+
+        result = json.loads(payload)
+        result["cached_at"] = created_at
+        return result
+
+    def put(self, company_name, result, variant=None):
+        """Store a completed analysis and evict expired or least recently used entries"""
+        cache_key = self.key(company_name, variant)
+        now = time.time()
+        with self._lock, self._conn as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results (cache_key, company_name, payload, created_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (cache_key, company_name, json.dumps(result), now, now)
+            )
+            conn.execute("DELETE FROM results WHERE created_at < ?", (now - self.ttl_seconds,))
+            conn.execute(
+                "DELETE FROM results WHERE cache_key NOT IN ("
+                " SELECT cache_key FROM results ORDER BY last_access DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+        logger.info(f"Cached analysis result for {company_name}")
@@ -0,0 +1,176 @@
+# scheduler.py
+
+import asyncio
+import logging
+import os
+import random
+import time
+
+import openai
+
+from metrics import LLM_RETRIES, LLM_THROTTLE
+
+# Set up logging
+logger = logging.getLogger('btmodel-web')
+
+# Shared request budget for every analysis in this process (0 = unlimited)
+RPM_LIMIT = int(os.environ.get("OPENAI_RPM_LIMIT", "0"))
+TPM_LIMIT = int(os.environ.get("OPENAI_TPM_LIMIT", "0"))
+MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "2"))
+RETRY_BASE_DELAY = float(os.environ.get("OPENAI_RETRY_BASE_DELAY", "1"))
+RETRY_MAX_DELAY = float(os.environ.get("OPENAI_RETRY_MAX_DELAY", "30"))
+
+# Completion size assumed when a request sets no max_tokens
+DEFAULT_COMPLETION_ESTIMATE = 500
+
+def estimate_tokens(messages, max_tokens=None):
+    """Rough token cost of a request, charged up front and corrected from the usage afterwards"""
+    prompt_chars = sum(len(message.get("content") or "") for message in messages)
+    return prompt_chars // 4 + (max_tokens or DEFAULT_COMPLETION_ESTIMATE)
+
+def retry_after_seconds(error):
+    """Server-requested delay from Retry-After (or OpenAI's retry-after-ms), or None"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+def is_retryable(error):
+    if isinstance(error, openai.RateLimitError):
+        # An exhausted quota will not recover by waiting
+        return getattr(error, "code", None) != "insufficient_quota"
+    return isinstance(error, (openai.APIConnectionError, openai.InternalServerError))
+
+# ---------------------------
+# Token Bucket
+# ---------------------------
+class TokenBucket:
+    """Per-minute budget that refills continuously; a zero limit never throttles"""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until amount can be taken"""
+        if not self.capacity:
+            return 0
+        self._refill()
+        # A single request larger than the whole budget waits for a full bucket
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0
+        return (amount - self.level) * 60 / self.capacity
+
+    def take(self, amount):
+        if self.capacity:
+            self._refill()
+            self.level = min(self.capacity, self.level - amount)
+
+# ---------------------------
+# Request Scheduler
+# ---------------------------
+class RequestScheduler:
+    """
+    Admits LLM requests from every concurrent analysis against shared
+    requests-per-minute and tokens-per-minute budgets, and retries transient
+    failures with jittered exponential backoff. A 429 pauses all requests
+    until its Retry-After has passed, so workers do not pile onto a limit
+    the server has already reported. Runs on the shared LLM event loop.
+    """
+
+    def __init__(self, rpm_limit=RPM_LIMIT, tpm_limit=TPM_LIMIT, max_retries=MAX_RETRIES,
+                 base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.requests = TokenBucket(rpm_limit)
+        self.tokens = TokenBucket(tpm_limit)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._paused_until = 0.0
+        self._lock = None
+
+    async def _admit(self, estimated_tokens):
+        # Created lazily so it belongs to the event loop that uses it
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        start = time.monotonic()
+        # Waiters queue on the lock, so requests are admitted in arrival order
+        async with self._lock:
+            while True:
+                wait = max(
+                    self._paused_until - time.monotonic(),
+                    self.requests.wait_time(1),
+                    self.tokens.wait_time(estimated_tokens)
+                )
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self.requests.take(1)
+            self.tokens.take(estimated_tokens)
+        waited = time.monotonic() - start
+        if waited > 0.01:
+            LLM_THROTTLE.observe(waited)
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """Correct the token budget once the real usage of the last attempt is known"""
+        if actual_tokens is not None:
+            self.tokens.take(actual_tokens - estimated_tokens)
+
+    def backoff(self, attempt, error):
+        delay = retry_after_seconds(error)
+        if delay is None:
+            # Full jitter: anywhere up to the exponential ceiling
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return min(delay, self.max_delay)
+
+    async def call(self, request, estimated_tokens, can_retry=None):
+        """
+        Await request() within the budget, retrying transient errors.
+        can_retry() is checked before each retry; streamed requests use it to
+        stop retrying once tokens have been passed on. Every attempt is
+        charged estimated_tokens; a failed one has no usage to settle, so its
+        charge is refunded, leaving settle() to correct the last attempt only.
+        """
+        attempt = 0
+        while True:
+            await self._admit(estimated_tokens)
+            try:
+                return await request()
+            except Exception as e:
+                self.tokens.take(-estimated_tokens)
+                if attempt >= self.max_retries or not is_retryable(e) or (can_retry and not can_retry()):
+                    raise
+                delay = self.backoff(attempt, e)
+                attempt += 1
+                reason = "rate_limit" if isinstance(e, openai.RateLimitError) else type(e).__name__
+                LLM_RETRIES.inc(reason=reason)
+                if isinstance(e, openai.RateLimitError):
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                logger.warning(f"LLM request failed ({reason}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            "rpm_limit": self.requests.capacity,
+            "tpm_limit": self.tokens.capacity,
+            "requests_available": round(self.requests.level, 1),
+            "tokens_available": round(self.tokens.level),
+            "paused_for": round(max(self._paused_until - time.monotonic(), 0), 2),
+            "max_retries": self.max_retries
+        }
+
+scheduler = RequestScheduler()
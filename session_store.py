@@ -0,0 +1,350 @@
+# session_store.py
+
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+# Set up logging
+logger = logging.getLogger('btmodel-web')
+
+# States returned by SessionStore.state()
+ACTIVE = "active"
+EXPIRED = "expired"
+MISSING = "missing"
+
+def field_size(key, value):
+    """Approximate memory footprint of one session field in bytes, from its JSON size"""
+    return len(json.dumps({key: value}, default=str))
+
+def estimate_size(data):
+    """Approximate memory footprint of a session in bytes, as the sum of its fields"""
+    return sum(field_size(key, value) for key, value in data.items())
+
+# ---------------------------
+# Session Store Interface
+# ---------------------------
+class SessionStore:
+    """
+    Storage for analysis sessions. Sessions are plain dicts; callers read a
+    copy with get() and change fields with update() rather than mutating
+    the stored dict, so implementations are free to keep them elsewhere.
+    """
+
+    def create(self, session_id, data):
+        raise NotImplementedError
+
+    def get(self, session_id):
+        """Return a copy of the session dict, or None if it is missing or expired"""
+        raise NotImplementedError
+
+    def update(self, session_id, **fields):
+        """Set fields on a session; returns False if the session no longer exists"""
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        raise NotImplementedError
+
+    def state(self, session_id):
+        """Return ACTIVE, EXPIRED (recently evicted) or MISSING"""
+        raise NotImplementedError
+
+    def items(self):
+        """Return a list of (session_id, session copy) pairs"""
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+    def __contains__(self, session_id):
+        return self.state(session_id) == ACTIVE
+
+# ---------------------------
+# In-Memory Session Store
+# ---------------------------
+class InMemorySessionStore(SessionStore):
+    """
+    In-process session store with TTL expiry (measured from the last access),
+    LRU eviction by entry count and approximate bytes, and a background
+    sweeper thread that drops expired sessions. on_remove(session_id) is
+    called, with the store's lock held, whenever a session is deleted,
+    expired or evicted, so data kept alongside sessions can go with them.
+    Sessions for which pinned(session) is true, such as queued or running
+    analyses, are never evicted; they still expire once idle for the TTL.
+    """
+
+    def __init__(self, ttl_seconds=6 * 3600, max_entries=1000, max_bytes=200 * 1024 * 1024,
+                 sweep_interval=60, max_tombstones=10000, on_remove=None, pinned=None):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_tombstones = max_tombstones
+        self.on_remove = on_remove
+        self.pinned = pinned
+
+        self._sessions = OrderedDict()  # session_id -> (data, size, last_access)
+        self._tombstones = OrderedDict()  # recently evicted ids, so we can report "expired"
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+        if sweep_interval:
+            sweeper = threading.Thread(target=self._sweep_forever, args=(sweep_interval,), name="session-sweeper")
+            sweeper.daemon = True
+            sweeper.start()
+
+    def create(self, session_id, data):
+        with self._lock:
+            data = dict(data)
+            self._store(session_id, data, estimate_size(data))
+            self._tombstones.pop(session_id, None)
+            self._enforce_limits()
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._live_entry(session_id)
+            if entry is None:
+                return None
+            data, size, _ = entry
+            self._sessions[session_id] = (data, size, time.time())
+            self._sessions.move_to_end(session_id)
+            return dict(data)
+
+    def update(self, session_id, **fields):
+        with self._lock:
+            entry = self._live_entry(session_id)
+            if entry is None:
+                logger.warning(f"Ignoring update for expired or missing session: {session_id}")
+                return False
+            data, size, _ = entry
+            # Only the changed fields are measured, not the whole session
+            for key, value in fields.items():
+                if key in data:
+                    size -= field_size(key, data[key])
+                size += field_size(key, value)
+            data.update(fields)
+            self._store(session_id, data, size)
+            self._enforce_limits()
+            return True
+
+    def delete(self, session_id):
+        with self._lock:
+            self._remove(session_id)
+
+    def state(self, session_id):
+        with self._lock:
+            if self._live_entry(session_id) is not None:
+                return ACTIVE
+            if session_id in self._tombstones:
+                return EXPIRED
+            return MISSING
+
+    def items(self):
+        with self._lock:
+            return [(session_id, dict(entry[0])) for session_id, entry in self._sessions.items()]
+
+    def sweep(self):
+        """Drop every session whose TTL has passed"""
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            expired = [session_id for session_id, entry in self._sessions.items() if entry[2] < cutoff]
+            for session_id in expired:
+                self._expire(session_id)
+        if expired:
+            logger.info(f"Session sweeper expired {len(expired)} sessions")
+        return len(expired)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "backend": "memory",
+                "sessions": len(self._sessions),
+                "bytes": self._total_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    # Helpers below expect the lock to be held
+
+    def _live_entry(self, session_id):
+        entry = self._sessions.get(session_id)
+        if entry is not None and entry[2] < time.time() - self.ttl_seconds:
+            self._expire(session_id)
+            return None
+        return entry
+
+    def _store(self, session_id, data, size):
+        previous = self._sessions.get(session_id)
+        if previous is not None:
+            self._total_bytes -= previous[1]
+        self._sessions[session_id] = (data, size, time.time())
+        self._sessions.move_to_end(session_id)
+        self._total_bytes += size
+
+    def _remove(self, session_id):
+        entry = self._sessions.pop(session_id, None)
+        if entry is not None:
+            self._total_bytes -= entry[1]
+            if self.on_remove:
+                try:
+                    self.on_remove(session_id)
+                except Exception as e:
+                    logger.error(f"Error cleaning up after session {session_id}: {str(e)}")
+        return entry
+
+    def _expire(self, session_id):
+        if self._remove(session_id) is not None:
+            self.expirations += 1
+            self._add_tombstone(session_id)
+
+    def _add_tombstone(self, session_id):
+        self._tombstones[session_id] = time.time()
+        while len(self._tombstones) > self.max_tombstones:
+            self._tombstones.popitem(last=False)
+
+    def _over_limits(self):
+        return len(self._sessions) > self.max_entries or self._total_bytes > self.max_bytes
+
+    def _enforce_limits(self):
+        # Evict least recently used sessions, skipping pinned ones and always keeping the newest one
+        if not self._over_limits():
+            return
+        for session_id in list(self._sessions)[:-1]:
+            if not self._over_limits():
+                break
+            if self.pinned and self.pinned(self._sessions[session_id][0]):
+                continue
+            self._remove(session_id)
+            self._add_tombstone(session_id)
+            self.evictions += 1
+
+    def _sweep_forever(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Error sweeping sessions: {str(e)}")
+
+# ---------------------------
+# Redis Session Store
+# ---------------------------
+class RedisSessionStore(SessionStore):
+    """
+    Session store backed by Redis (or any Redis-compatible server, such as
+    fakeredis in development) so several app processes can serve the same
+    sessions. Each session is a hash with JSON-encoded fields, so update()
+    only writes the changed fields and needs no read-modify-write. A marker
+    field makes sure even an empty session has a hash. TTL is refreshed on
+    every access; memory bounds and LRU eviction are left to the server's
+    maxmemory policy.
+    """
+
+    # Hash field written by create(), so the hash exists for an empty session
+    CREATED_FIELD = "__created__"
+
+    def __init__(self, client, ttl_seconds=6 * 3600, prefix="btmodel"):
+        self.client = client
+        self.ttl_seconds = int(ttl_seconds)
+        self.prefix = prefix
+        # Marker that outlives the session so we can tell "expired" from "missing"
+        self.marker_ttl_seconds = max(self.ttl_seconds * 4, 24 * 3600)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        # Optional dependency, only needed when SESSION_BACKEND=redis
+        import redis
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def _key(self, session_id):
+        return f"{self.prefix}:session:{session_id}"
+
+    def _marker_key(self, session_id):
+        return f"{self.prefix}:known-session:{session_id}"
+
+    def _encode(self, fields):
+        return {name: json.dumps(value, default=str) for name, value in fields.items()}
+
+    def create(self, session_id, data):
+        key = self._key(session_id)
+        pipe = self.client.pipeline()
+        pipe.delete(key)
+        pipe.hset(key, mapping=dict(self._encode(data), **{self.CREATED_FIELD: "1"}))
+        pipe.expire(key, self.ttl_seconds)
+        pipe.set(self._marker_key(session_id), 1, ex=self.marker_ttl_seconds)
+        pipe.execute()
+
+    def get(self, session_id):
+        key = self._key(session_id)
+        pipe = self.client.pipeline()
+        pipe.hgetall(key)
+        pipe.expire(key, self.ttl_seconds)
+        raw, _ = pipe.execute()
+        if not raw:
+            return None
+        fields = {(name.decode() if isinstance(name, bytes) else name): value for name, value in raw.items()}
+        fields.pop(self.CREATED_FIELD, None)
+        return {name: json.loads(value) for name, value in fields.items()}
+
+    def update(self, session_id, **fields):
+        key = self._key(session_id)
+        mapping = self._encode(fields)
+
+        def write(pipe):
+            # Checked and written in one transaction (WATCH/MULTI), so a
+            # session that expires in between is not brought back half-filled
+            if not pipe.exists(key):
+                return False
+            pipe.multi()
+            if mapping:
+                pipe.hset(key, mapping=mapping)
+            pipe.expire(key, self.ttl_seconds)
+            return True
+
+        if not self.client.transaction(write, key, value_from_callable=True):
+            logger.warning(f"Ignoring update for expired or missing session: {session_id}")
+            return False
+        return True
+
+    def delete(self, session_id):
+        self.client.delete(self._key(session_id), self._marker_key(session_id))
+
+    def state(self, session_id):
+        if self.client.exists(self._key(session_id)):
+            return ACTIVE
+        if self.client.exists(self._marker_key(session_id)):
+            return EXPIRED
+        return MISSING
+
+    def _session_ids(self):
+        prefix = self._key("")
+        for key in self.client.scan_iter(match=f"{prefix}*"):
+            key = key.decode() if isinstance(key, bytes) else key
+            yield key[len(prefix):]
+
+    def items(self):
+        items = []
+        for session_id in self._session_ids():
+            data = self.get(session_id)
+            if data is not None:
+                items.append((session_id, data))
+        return items
+
+    def stats(self):
+        return {
+            "backend": "redis",
+            "sessions": len(self),
+            "ttl_seconds": self.ttl_seconds
+        }
+
+    def __len__(self):
+        return sum(1 for _ in self._session_ids())
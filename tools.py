@@ -1,49 +1,219 @@
 # tools.py
 
+import asyncio
 import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from dotenv import load_dotenv
 
+from llm import AnalysisInterrupted
+
 # Set up logging
 logger = logging.getLogger('btmodel-web')
 
 # Load environment variables
 load_dotenv()
 
+# "fake" returns canned results from fake_backend.py instead of searching
+SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND", "duckduckgo")
+
+# Seconds a single web search may take
+SEARCH_TIMEOUT = float(os.environ.get("SEARCH_TIMEOUT", "10"))
+
+# Threads web searches run on, apart from the other blocking calls, so
+# searches left hanging after a timeout cannot hold up store writes and emits
+SEARCH_THREADS = int(os.environ.get("SEARCH_THREADS", "8"))
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_THREADS, thread_name_prefix="search")
+
+# ---------------------------
+# Search Result Cache
+# ---------------------------
+# Handed to the callers waiting on a leader that was interrupted; one of them computes again
+_RETRY = object()
+
+def is_interruption(error):
+    """Whether error stops only the caller that raised it (cancelled, out of time) rather than the computation"""
+    return isinstance(error, AnalysisInterrupted) or not isinstance(error, Exception)
+
+class SearchCache:
+    """
+    LRU cache with TTL for web search results. Concurrent callers asking for
+    a query that is already being searched wait for that search instead of
+    issuing a duplicate one (single-flight). If the caller doing the search
+    is interrupted, a waiting caller takes over instead of failing too.
+    """
+
+    def __init__(self, max_entries=256, ttl_seconds=3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (expires_at, result)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached result for key, or call compute() once for all
+        concurrent callers. compute returns (result, cacheable).
+        """
+        while True:
+            flight, leader = self._claim(key)
+            if leader:
+                break
+            result = flight.result()
+            if result is not _RETRY:
+                return result
+        try:
+            result, cacheable = compute()
+        except BaseException as e:
+            self._land(key, flight, error=e)
+            raise
+        self._land(key, flight, result, cacheable)
+        return result
+
+    async def aget_or_compute(self, key, compute):
+        """
+        Like get_or_compute(), for a coroutine function compute. Callers on
+        the event loop and in threads share the same searches.
+        """
+        while True:
+            flight, leader = self._claim(key)
+            if leader:
+                break
+            # A waiter that is cancelled must not cancel the search for the others
+            result = await asyncio.shield(asyncio.wrap_future(flight))
+            if result is not _RETRY:
+                return result
+        try:
+            result, cacheable = await compute()
+        except BaseException as e:
+            self._land(key, flight, error=e)
+            raise
+        self._land(key, flight, result, cacheable)
+        return result
+
+    def _claim(self, key):
+        """
+        Return (flight, leader): a future for key's result, already done on a
+        cache hit, and whether this caller has to compute it for the others.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    flight = Future()
+                    flight.set_result(entry[1])
+                    return flight, False
+                del self._entries[key]
+
+            flight = self._in_flight.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return flight, False
+            flight = self._in_flight[key] = Future()
+            self.misses += 1
+            return flight, True
+
+    def _land(self, key, flight, result=None, cacheable=False, error=None):
+        """Hand the leader's result or error to the waiting callers; an interruption makes them retry"""
+        with self._lock:
+            del self._in_flight[key]
+            if error is None and cacheable:
+                self._entries[key] = (time.time() + self.ttl_seconds, result)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        if error is None:
+            flight.set_result(result)
+        elif is_interruption(error):
+            flight.set_result(_RETRY)
+        else:
+            flight.set_exception(error)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._in_flight)
+            }
+
+search_cache = SearchCache(
+    max_entries=int(os.environ.get("SEARCH_CACHE_SIZE", "256")),
+    ttl_seconds=float(os.environ.get("SEARCH_CACHE_TTL", "3600"))
+)
+
+def normalize_query(query):
+    """Normalize a search query so trivially different spellings share a cache entry"""
+    return " ".join(query.lower().split())
+
 def web_search(query):
     """
     Perform a web search using DuckDuckGo and return formatted results.
+    Results are cached and concurrent identical searches are coalesced.
     Falls back to a simulated response if the real search fails.
     """
+    results = web_search_results(query)
+    if not results:
+        return simulate_search(query)
+    
+    return "\n\n".join(f"{result['title']}: {result['snippet']}" for result in results)
+
+def web_search_results(query):
+    """
+    Perform a cached web search and return a list of {"title", "snippet"}
+    dicts, or None if the search failed or found nothing.
+    """
+    return search_cache.get_or_compute(normalize_query(query), lambda: _search(query))
+
+def _search(query):
+    """Run the actual search. Returns (results, cacheable); failures are not cached."""
     try:
         logger.info(f"Performing web search for: {query}")
         
+        if SEARCH_BACKEND == "fake":
+            from fake_backend import fake_search_results
+            return fake_search_results(query), True
+        
         # Try to import and use the DuckDuckGo search
         try:
             from duckduckgo_search import DDGS
             
             # Perform the search
-            results = DDGS().text(query, max_results=5)
+            results = DDGS(timeout=SEARCH_TIMEOUT).text(query, max_results=5)
             
             if not results:
                 logger.warning(f"No search results found for: {query}")
-                return simulate_search(query)
+                return None, False
             
-            # Format the results
+            # Keep only the fields we use
             output = []
             for result in results:
-                title = result.get("title", "No Title")
-                snippet = result.get("body", "No snippet available.")
-                output.append(f"{title}: {snippet}")
+                output.append({
+                    "title": result.get("title", "No Title"),
+                    "snippet": result.get("body", "No snippet available.")
+                })
             
-            return "\n\n".join(output)
+            return output, True
             
         except ImportError as e:
             logger.warning(f"DuckDuckGo search package not available: {str(e)}")
-            return simulate_search(query)
+            return None, False
             
     except Exception as e:
         logger.error(f"Error in web search: {str(e)}")
-        return simulate_search(query)
+        return None, False
 
 def simulate_search(company_name):
     """Generate simulated search results if real search fails"""
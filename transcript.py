@@ -0,0 +1,145 @@
+# transcript.py
+
+import os
+import re
+
+# Rough conversion used for prompt budgets; good enough for English text
+CHARS_PER_TOKEN = 4
+
+# Default prompt budget for the discussion context given to each agent
+DEFAULT_CONTEXT_TOKENS = int(os.environ.get("AGENT_CONTEXT_TOKENS", "1500"))
+
+# Separate prompt budget for the research quoted in every discussion prompt
+RESEARCH_CONTEXT_TOKENS = int(os.environ.get("RESEARCH_CONTEXT_TOKENS", "1000"))
+
+def compress_text(text, max_chars=200):
+    """Keep the first sentence of a turn (at most max_chars) as its gist"""
+    text = " ".join(text.split())
+    match = re.match(r"(.+?[.!?])(\s|$)", text)
+    gist = match.group(1) if match else text
+    if len(gist) > max_chars:
+        gist = gist[:max_chars - 3].rstrip() + "..."
+    return gist
+
+def trim_text(text, max_chars):
+    """Cut text to at most max_chars, at the last paragraph or sentence end if one is near"""
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    end = max(cut.rfind("\n\n"), cut.rfind(". "))
+    if end > max_chars // 2:
+        cut = cut[:end + 1]
+    return cut.rstrip() + " [...]"
+
+# ---------------------------
+# Discussion Turn
+# ---------------------------
+class Turn:
+    """One contribution to the discussion"""
+
+    def __init__(self, round_number, speaker, text, to=None):
+        self.round_number = round_number
+        self.speaker = speaker
+        self.text = text
+        self.to = to
+        self._gist = None
+
+    @property
+    def line(self):
+        """The turn as a legacy transcript line"""
+        if self.to:
+            return f"{self.speaker} (to {self.to}): {self.text}"
+        return f"{self.speaker}: {self.text}"
+
+    @property
+    def gist(self):
+        """Compressed form of the turn used once it falls out of the verbatim window"""
+        if self._gist is None:
+            self._gist = f"{self.speaker}: {compress_text(self.text)}"
+        return self._gist
+
+    def to_dict(self):
+        return {"round": self.round_number, "speaker": self.speaker, "to": self.to, "text": self.text}
+
+# ---------------------------
+# Transcript
+# ---------------------------
+class Transcript:
+    """
+    Append-only record of the discussion. Agent prompts are built from a
+    token budget: the most recent turns verbatim, and a rolling summary made
+    of the gists of older turns, so prompt size stays flat as rounds grow.
+    """
+
+    def __init__(self):
+        self.turns = []
+        self.round_number = 0
+
+    def start_round(self, round_number):
+        self.round_number = round_number
+
+    def add_turn(self, speaker, text, to=None):
+        turn = Turn(self.round_number, speaker, text, to=to)
+        self.turns.append(turn)
+        return turn
+
+    def last_turn_by(self, speaker):
+        for turn in reversed(self.turns):
+            if turn.speaker == speaker:
+                return turn
+        return None
+
+    def round_header(self, round_number):
+        return f"\n=== Expert Discussion - Round {round_number} ==="
+
+    def lines(self):
+        """The transcript in the legacy list-of-lines format used by the UI and summarizer"""
+        lines = []
+        current_round = None
+        for turn in self.turns:
+            if turn.round_number != current_round:
+                current_round = turn.round_number
+                lines.append(self.round_header(current_round))
+            lines.append(turn.line)
+            if turn.speaker != "Facilitator":
+                lines.append("")  # Empty line for spacing
+        return lines
+
+    def text(self):
+        """The full transcript as text"""
+        return "\n".join(self.lines())
+
+    def context(self, budget_tokens=DEFAULT_CONTEXT_TOKENS):
+        """
+        Build the discussion context for a prompt within budget_tokens:
+        recent turns verbatim, older turns as a rolling compressed summary.
+        """
+        if not self.turns:
+            return "This is the start of our discussion."
+
+        budget_chars = budget_tokens * CHARS_PER_TOKEN
+
+        # Newest turns verbatim, keeping roughly a quarter of the budget for the summary
+        verbatim = []
+        used = 0
+        for turn in reversed(self.turns):
+            if verbatim and used + len(turn.line) > budget_chars * 0.75:
+                break
+            verbatim.insert(0, turn.line)
+            used += len(turn.line)
+
+        older_turns = self.turns[:len(self.turns) - len(verbatim)]
+        if not older_turns:
+            return "\n".join(verbatim)
+
+        # Rolling summary of everything older, dropping the oldest gists if it does not fit
+        gists = [turn.gist for turn in older_turns]
+        summary_budget = max(budget_chars - used, 0)
+        while gists and sum(len(gist) + 1 for gist in gists) > summary_budget:
+            gists.pop(0)
+
+        sections = []
+        if gists:
+            sections.append("Summary of earlier discussion:\n" + "\n".join(gists))
+        sections.append("Most recent discussion:\n" + "\n".join(verbatim))
+        return "\n\n".join(sections)